@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Clipboard Image Saver 基准测试 / Clipboard Image Saver benchmarks
+用法：python bench.py {all,detect,e2e,formats,idle,resize} [--json out.json]
+Usage: python bench.py {all,detect,e2e,formats,idle,resize} [--json out.json]
+用 FakeClipboard 代替真实剪贴板，无需显示器 / Uses FakeClipboard instead of the real clipboard, needs no display
+"""
+import os
+import sys
+import json
+import math
+import queue
+import random
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+
+from PIL import Image, ImageChops, ImageDraw, ImageStat
+
+import clipimg
+
+# ----------------------------------------------------------
+# 合成图片 / Synthetic images
+def synthetic_image(size, mode="RGB", seed=0):
+    # 渐变 + 噪声纹理 + 细线和色块，近似截图中的平滑区域与锐利边缘
+    # Gradients + noise texture + thin lines and blocks, roughly the smooth areas and sharp edges of a screenshot
+    w, h = size
+    rnd = random.Random(seed)
+    tile = (max(1, w // 4), max(1, h // 4))
+    n = tile[0] * tile[1]
+    noise = Image.frombytes("L", tile, rnd.getrandbits(8 * n).to_bytes(n, "little"))
+    im = Image.merge("RGB", (Image.linear_gradient("L").resize(size),
+                             Image.radial_gradient("L").resize(size),
+                             noise.resize(size, Image.NEAREST)))
+    d = ImageDraw.Draw(im)
+    step = max(8, w // 160)
+    for x in range(0, w, step):
+        d.line((x, 0, x, h), fill=(255, 255, 255), width=1)
+    for _ in range(64):
+        x, y = rnd.randrange(w), rnd.randrange(h)
+        d.rectangle((x, y, x + w // 20, y + h // 40),
+                    fill=(rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)))
+    return im if mode == "RGB" else im.convert(mode)
+
+
+def parse_size(value):
+    w, h = (int(x) for x in value.lower().split("x"))
+    return w, h
+
+
+def percentiles(xs):
+    xs = sorted(xs)
+    if not xs:
+        return {"n": 0}
+    return {"n": len(xs), "mean": round(statistics.mean(xs), 3),
+            "p50": round(xs[(len(xs) - 1) // 2], 3),
+            "p95": round(xs[min(len(xs) - 1, int(len(xs) * 0.95))], 3),
+            "max": round(xs[-1], 3)}
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+            return round(psutil.Process().memory_info().peak_wset / 1e6, 1)
+        except Exception:
+            return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 以字节为单位，Linux 以 KB 为单位 / Bytes on macOS, KB on Linux
+    return round(peak / 1e6 if sys.platform == "darwin" else peak / 1e3, 1)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+class FakeSource:
+    # 以固定频率改变假剪贴板内容；每次改一个像素，保证都是新内容
+    # Changes the fake clipboard at a fixed rate; one pixel differs each time so every change is new content
+    def __init__(self, clip, size, mode, rate, count):
+        self.clip = clip
+        self.base = synthetic_image(size, mode)
+        self.period = 1.0 / rate
+        self.count = count
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        start = time.perf_counter()
+        w, h = self.base.size
+        for i in range(self.count):
+            im = self.base.copy()
+            im.putpixel((i % w, (i // w) % h), (i * 37) % 256 if len(im.getbands()) == 1
+                        else ((i * 37) % 256,) * len(im.getbands()))
+            delay = start + i * self.period - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self.clip.set(im)
+
+    def start(self):
+        self.thread.start()
+
+    def drained(self, grace):
+        # 源已结束且最后一次变化已过去 grace 秒 / Source finished and the last change is `grace` seconds old
+        return (not self.thread.is_alive() and self.clip.set_at is not None
+                and time.perf_counter() - self.clip.set_at > grace)
+
+
+def compare(ref, out):
+    diff = ImageChops.difference(ref.convert("RGB"), out.convert("RGB"))
+    st = ImageStat.Stat(diff)
+    rms = math.sqrt(sum(r * r for r in st.rms) / len(st.rms))
+    return {"mean_abs_diff": sum(st.mean) / len(st.mean),
+            "max_diff": max(hi for _, hi in st.extrema),
+            "psnr_db": 20 * math.log10(255 / rms) if rms else None}
+
+# ----------------------------------------------------------
+# 缩放 / Resize
+def _baseline_resize(im, dst, mode):
+    # 改动前的缩放：长边模式原地 thumbnail（默认 reducing_gap=2.0），宽高模式用普通 LANCZOS resize
+    # The resize before resample settings existed: in-place thumbnail (default reducing_gap=2.0)
+    # for long_edge, a plain LANCZOS resize for wh
+    if mode == "wh":
+        return im.resize(dst, Image.LANCZOS)
+    im.thumbnail(dst, Image.LANCZOS)
+    return im
+
+
+def bench_resize(sizes, long_edge, repeat, mode="long_edge", wh=(1920, 1080)):
+    # 速度相对改动前的基线，差异相对全分辨率 LANCZOS（quality）
+    # Speedup is against the baseline row, differences against full-resolution LANCZOS (quality)
+    results = []
+    for size in sizes:
+        src = synthetic_image(size)
+        dst = wh if mode == "wh" else clipimg.fit_long_edge(size, long_edge)
+        ref = clipimg.resize_to(src, dst, "quality")
+        base_ms = None
+        rows = [("baseline", lambda im: _baseline_resize(im, dst, mode))]
+        rows += [(speed, lambda im, speed=speed: clipimg.resize_to(im, dst, speed))
+                 for speed in clipimg.RESIZE_SPEEDS]
+        for name, run in rows:
+            times = []
+            for _ in range(repeat):
+                # thumbnail 原地修改，复制不计入耗时 / thumbnail works in place; the copy is not timed
+                im = src.copy() if name == "baseline" else src
+                t0 = time.perf_counter()
+                out = run(im)
+                times.append((time.perf_counter() - t0) * 1000)
+            ms = statistics.median(times)
+            if base_ms is None:
+                base_ms = ms
+            row = {"source": "{}x{}".format(*size), "target": "{}x{}".format(*out.size),
+                   "resample": name, "ms": round(ms, 2),
+                   "speedup": round(base_ms / ms, 2) if ms else None}
+            row.update({k: None if v is None else round(v, 3)
+                        for k, v in compare(ref, out).items()})
+            results.append(row)
+            print("{source:>11} -> {target:<9} {resample:<9} {ms:9.1f} ms  x{speedup:<5} "
+                  "mean diff {mean_abs_diff:6.3f}  max {max_diff:3d}  PSNR {psnr} dB"
+                  .format(psnr="{:6.2f}".format(row["psnr_db"]) if row["psnr_db"] else "   inf",
+                          **row))
+    return results
+
+# ----------------------------------------------------------
+# 检测延迟：改变假剪贴板 -> 监视线程送出结果 / Detection latency: fake clipboard change -> monitor result
+def bench_detect(size, mode, rate, count, poll_min, poll_max):
+    clip = clipimg.FakeClipboard()
+    out = queue.Queue()
+    mon = clipimg.ClipboardMonitor(clip, out, poll_min, poll_max)
+    src = FakeSource(clip, size, mode, rate, count)
+    mon.start()
+    src.start()
+    latencies, grab_ms = [], []
+    while len(latencies) < count and not src.drained(poll_max + 1):
+        try:
+            im, digest, active, timings = out.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        if active and im is not None:
+            latencies.append((time.perf_counter() - clip.set_at) * 1000)
+            grab_ms.append(timings.get("grab", 0.0) + timings.get("fingerprint", 0.0))
+    mon.stop()
+    res = {"size": "{}x{}".format(*size), "mode": mode, "rate_hz": rate,
+           "changes": count, "detected": len(latencies),
+           "latency_ms": percentiles(latencies), "grab_fingerprint_ms": percentiles(grab_ms),
+           "grabs": clip.grabs, "peak_rss_mb": peak_rss_mb()}
+    print("detect   {size} {mode}: {detected}/{changes} changes, latency p50 {p50} ms p95 {p95} ms, "
+          "{grabs} grabs".format(**res, **res["latency_ms"]))
+    return res
+
+
+# 端到端：改变剪贴板 -> 文件落盘 / End to end: clipboard change -> file on disk
+def bench_e2e(size, mode, rate, count, fmt, workers, poll_min, poll_max):
+    clip = clipimg.FakeClipboard()
+    out = queue.Queue()
+    mon = clipimg.ClipboardMonitor(clip, out, poll_min, poll_max)
+    executor = clipimg.SaveExecutor(workers, max_queue=count)
+    latencies, lock = [], threading.Lock()
+    with tempfile.TemporaryDirectory() as d:
+        opts = clipimg.SaveOptions(directory=d, fmt=fmt)
+
+        def save(im, set_at):
+            clipimg.save_image_file(im, clipimg.make_output_path(opts), opts)
+            with lock:
+                latencies.append((time.perf_counter() - set_at) * 1000)
+
+        src = FakeSource(clip, size, mode, rate, count)
+        mon.start()
+        src.start()
+        t0 = time.perf_counter()
+        submitted = 0
+        while submitted < count and not src.drained(poll_max + 1):
+            try:
+                im, digest, active, _ = out.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if active and im is not None:
+                executor.submit(save, im, clip.set_at, key=digest)
+                submitted += 1
+        mon.stop()
+        executor.shutdown(wait=True, timeout=60)
+        elapsed = time.perf_counter() - t0
+    res = {"size": "{}x{}".format(*size), "mode": mode, "format": fmt, "rate_hz": rate,
+           "changes": count, "saved": len(latencies), "workers": workers,
+           "latency_ms": percentiles(latencies),
+           "saves_per_s": round(len(latencies) / elapsed, 2),
+           "executor": executor.stats(), "peak_rss_mb": peak_rss_mb()}
+    print("e2e      {size} {mode} -> {format}: {saved}/{changes} saved, latency p50 {p50} ms "
+          "p95 {p95} ms".format(**res, **res["latency_ms"]))
+    return res
+
+
+# 每种格式的保存吞吐量 / Save throughput per FORMATS entry
+def bench_formats(size, mode, count, quality):
+    im = synthetic_image(size, mode)
+    raw_mb = im.width * im.height * len(im.getbands()) / 1e6
+    results = []
+    with tempfile.TemporaryDirectory() as d:
+        for fmt in clipimg.FORMATS:
+            opts = clipimg.SaveOptions(directory=d, fmt=fmt, quality=quality)
+            times, sizes = [], []
+            for _ in range(count):
+                t0 = time.perf_counter()
+                path = clipimg.save_image_file(im, clipimg.make_output_path(opts), opts)
+                times.append(time.perf_counter() - t0)
+                sizes.append(os.path.getsize(path))
+                os.remove(path)
+            total = sum(times)
+            row = {"format": fmt, "size": "{}x{}".format(*size), "mode": mode,
+                   "ms": percentiles([t * 1000 for t in times]),
+                   "images_per_s": round(count / total, 2),
+                   "raw_mb_per_s": round(raw_mb * count / total, 2),
+                   "file_kb": round(statistics.mean(sizes) / 1024, 1)}
+            results.append(row)
+            print("formats  {format:<5} {images_per_s:7.2f} images/s {raw_mb_per_s:8.1f} MB/s "
+                  "{file_kb:9.1f} KB".format(**row))
+    return {"results": results, "peak_rss_mb": peak_rss_mb()}
+
+
+# 空闲 CPU：剪贴板里有一张大图但不变化 / Idle CPU with a large, unchanged image on the clipboard
+def bench_idle(size, mode, seconds, poll_min, poll_max):
+    clip = clipimg.FakeClipboard(synthetic_image(size, mode))
+    out = queue.Queue()
+    mon = clipimg.ClipboardMonitor(clip, out, poll_min, poll_max)
+    mon.start()
+    time.sleep(min(1.0, seconds / 4))
+    grabs0, cpu0, wall0 = clip.grabs, time.process_time(), time.perf_counter()
+    time.sleep(seconds)
+    cpu = time.process_time() - cpu0
+    wall = time.perf_counter() - wall0
+    mon.stop()
+    res = {"size": "{}x{}".format(*size), "mode": mode, "seconds": round(wall, 2),
+           "cpu_percent": round(100 * cpu / wall, 3), "grabs": clip.grabs - grabs0,
+           "interval_ms": round(mon.interval * 1000, 1), "peak_rss_mb": peak_rss_mb()}
+    print("idle     {size} {mode}: {cpu_percent}% CPU, {grabs} grabs in {seconds} s, "
+          "poll interval {interval_ms} ms".format(**res))
+    return res
+
+# ----------------------------------------------------------
+def main(argv=None):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--json", metavar="PATH", help="also write results as JSON ('-' for stdout)")
+    parser = argparse.ArgumentParser(description="Clipboard Image Saver benchmarks")
+    sub = parser.add_subparsers(dest="command")
+    p = sub.add_parser("resize", parents=[common],
+                       help="resize latency and output difference per resize speed")
+    p.add_argument("--sizes", type=lambda v: [parse_size(s) for s in v.split(",")],
+                   default=[(1920, 1080), (3840, 2160), (7680, 4320), (15360, 4320)])
+    p.add_argument("--resize-mode", choices=("long_edge", "wh"), default="long_edge")
+    p.add_argument("--long-edge", type=int, default=1920)
+    p.add_argument("--wh", type=parse_size, default=(1920, 1080), help="WIDTHxHEIGHT for wh mode")
+    p.add_argument("--repeat", type=int, default=3)
+
+    source = argparse.ArgumentParser(add_help=False, parents=[common])
+    source.add_argument("--size", type=parse_size, default=(3840, 2160), help="WIDTHxHEIGHT")
+    source.add_argument("--mode", default="RGBA", help="image mode, e.g. RGB, RGBA, L")
+    source.add_argument("--rate", type=float, default=2.0, help="clipboard changes per second")
+    source.add_argument("--count", type=int, default=20, help="number of changes / saves")
+    source.add_argument("--seconds", type=float, default=10.0, help="idle measurement time")
+    source.add_argument("--format", default="PNG", choices=list(clipimg.FORMATS))
+    source.add_argument("--quality", type=int, default=90)
+    source.add_argument("--workers", type=int, default=2)
+    source.add_argument("--poll-min-ms", type=float, default=200)
+    source.add_argument("--poll-max-ms", type=float, default=2000)
+    for name, text in (("detect", "detection latency of the clipboard monitor"),
+                       ("e2e", "capture-to-disk latency through the save executor"),
+                       ("formats", "save throughput per FORMATS entry"),
+                       ("idle", "idle CPU with an unchanged image on the clipboard"),
+                       ("all", "detect, e2e, formats and idle")):
+        sub.add_parser(name, parents=[source], help=text)
+    args = parser.parse_args(argv)
+
+    if args.command is None:
+        parser.print_help()
+        return 2
+    if args.command == "resize":
+        results = bench_resize(args.sizes, args.long_edge, args.repeat, args.resize_mode, args.wh)
+    else:
+        poll = (args.poll_min_ms / 1000, args.poll_max_ms / 1000)
+        results = {}
+        if args.command in ("detect", "all"):
+            results["detect"] = bench_detect(args.size, args.mode, args.rate, args.count, *poll)
+        if args.command in ("e2e", "all"):
+            results["e2e"] = bench_e2e(args.size, args.mode, args.rate, args.count,
+                                       args.format, args.workers, *poll)
+        if args.command in ("formats", "all"):
+            results["formats"] = bench_formats(args.size, args.mode,
+                                               max(1, args.count // 5), args.quality)
+        if args.command in ("idle", "all"):
+            results["idle"] = bench_idle(args.size, args.mode, args.seconds, *poll)
+
+    if args.json:
+        doc = {"benchmark": args.command, "time": time.time(), "commit": git_commit(),
+               "python": platform.python_version(), "pillow": Image.__version__,
+               "platform": platform.platform(), "cpus": os.cpu_count(),
+               "peak_rss_mb": peak_rss_mb(), "results": results}
+        text = json.dumps(doc, indent=2)
+        if args.json == "-":
+            print(text)
+        else:
+            with open(args.json, "w", encoding="utf8") as f:
+                f.write(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
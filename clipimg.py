@@ -8,16 +8,38 @@ Clipboard Image Saver – 监听版 / Clipboard Image Saver – Listener Edition
 托盘：tray_icon.png（托盘图标） / Tray: tray_icon.png (tray icon)
 打包：build.ps1 / Packaging: build.ps1
 """
+import io
 import os
 import sys
+import glob
 import json
+import argparse
+import hashlib
+import hmac
+import math
 import pathlib
+import shutil
+import sqlite3
+import subprocess
+import tempfile
 import threading
 import queue
+import secrets
 import time
+import logging
+import logging.handlers
+import urllib.parse
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime
-import tkinter as tk
-from tkinter import ttk, filedialog, messagebox
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import NamedTuple
+# 没有 Tk 的 Python（如服务器）仍可使用引擎和命令行 / Pythons without Tk (e.g. servers) can still use the engine and CLI
+try:
+    import tkinter as tk
+    from tkinter import ttk, filedialog, messagebox
+except ImportError:
+    tk = None
 
 try:
     from PIL import Image, ImageGrab
@@ -25,6 +47,14 @@ except ImportError as e:
     print("Pillow is required: pip install pillow / Pillow 是必需的：pip install pillow")
     sys.exit(1)
 import pyperclip
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # ----------------------------------------------------------
 # 语言资源 / Language resources
@@ -48,9 +78,13 @@ LANG = {
         "long_px": "长边像素：",
         "width": "宽：",
         "height": "高：",
+        "resample": "缩放：",
+        "resample_options": ["质量优先", "均衡", "快速", "最快"],
         "override": "允许覆盖",
         "copy_path": "保存后复制路径到剪贴板",
         "listen_mode": "监听剪贴板",
+        "use_profile": "多目标导出",
+        "max_kb": "上限 KB：",
         "saved": "已保存：\n{}",
         "auto_saved": "自动保存：{}",
         "err_no_img": "剪贴板无图片",
@@ -68,7 +102,28 @@ LANG = {
         "log_listen_on": "监听模式已开启",
         "log_listen_off": "监听模式已关闭",
         "log_tray_required": "托盘功能需安装 pystray 和 pillow",
-        "log_hotkey_required": "全局热键需安装 pynput"
+        "log_hotkey_required": "全局热键需安装 pynput",
+        "log_watcher": "剪贴板监视后端：{}",
+        "log_grab": "读取剪贴板耗时 {:.1f} ms，下次轮询间隔 {:.0f} ms",
+        "log_dup": "内容已保存过，跳过：{}",
+        "log_queue_drop": "保存队列已满，丢弃最旧任务（排队 {}，进行中 {}，累计丢弃 {}）",
+        "log_queue_coalesce": "保存队列已满，合并为最新截图（排队 {}，进行中 {}，累计合并 {}）",
+        "tray_queue": "排队 {} · 进行中 {} · 丢弃 {}",
+        "log_profile": "多目标导出：{}",
+        "log_metrics": "阶段耗时 {}",
+        "log_near_dup": "近似重复（汉明距离 {}），已跳过，累计跳过 {} 张",
+        "log_numpy_required": "近似去重需安装 numpy",
+        "log_mem_refuse": "图片约需 {:.0f} MB，超出内存预算 {} MB，已跳过",
+        "log_mem_peak": "本次保存峰值内存约 {:.0f} MB（预算 {} MB）",
+        "files": "✅ 已复制 {} 个图片文件",
+        "log_ingest_start": "导入 {} 个文件（{} 个线程）",
+        "log_ingest_progress": "[{}/{}] {}",
+        "log_ingest_fail": "导入失败 {}：{}",
+        "log_ingest_done": "导入完成：{} 个（其中原样复制 {} 个，失败 {} 个），{:.2f} 秒，{:.1f} 张/秒，{:.1f} MB/秒",
+        "log_server": "本地导入接口：http://127.0.0.1:{}/save（令牌见 {}）",
+        "log_server_fail": "本地导入接口启动失败：{}",
+        "log_archive": "保存到归档：{}",
+        "log_recompress": "后台重新压缩 {}：{:.0f} KB → {:.0f} KB，累计节省 {:.1f} MB"
     },
     "en": {
         "app": "Clipboard Image Saver",
@@ -89,9 +144,13 @@ LANG = {
         "long_px": "Long edge(px):",
         "width": "Width:",
         "height": "Height:",
+        "resample": "Resize:",
+        "resample_options": ["Best quality", "Balanced", "Fast", "Fastest"],
         "override": "Allow overwrite",
         "copy_path": "Copy path to clipboard after save",
         "listen_mode": "Listen to clipboard",
+        "use_profile": "Export profile",
+        "max_kb": "Max KB:",
         "saved": "Saved:\n{}",
         "auto_saved": "Auto saved: {}",
         "err_no_img": "No image in clipboard",
@@ -109,17 +168,45 @@ LANG = {
         "log_listen_on": "Listen mode enabled",
         "log_listen_off": "Listen mode disabled",
         "log_tray_required": "Tray requires pystray and pillow",
-        "log_hotkey_required": "Global hotkey requires pynput"
+        "log_hotkey_required": "Global hotkey requires pynput",
+        "log_watcher": "Clipboard watcher: {}",
+        "log_grab": "Clipboard grab took {:.1f} ms, next poll in {:.0f} ms",
+        "log_dup": "Already saved, skipped: {}",
+        "log_queue_drop": "Save queue full, dropped oldest job (queued {}, in flight {}, dropped {})",
+        "log_queue_coalesce": "Save queue full, coalesced into newest capture (queued {}, in flight {}, coalesced {})",
+        "tray_queue": "queued {} · in flight {} · dropped {}",
+        "log_profile": "Export profile: {}",
+        "log_metrics": "Stage timings {}",
+        "log_near_dup": "Near-duplicate (Hamming distance {}) skipped, {} skipped so far",
+        "log_numpy_required": "Near-duplicate filter requires numpy",
+        "log_mem_refuse": "Capture needs ~{:.0f} MB, over the {} MB memory budget; skipped",
+        "log_mem_peak": "Save peak memory ~{:.0f} MB (budget {} MB)",
+        "files": "✅ {} image files copied",
+        "log_ingest_start": "Importing {} files ({} threads)",
+        "log_ingest_progress": "[{}/{}] {}",
+        "log_ingest_fail": "Import failed {}: {}",
+        "log_ingest_done": "Import done: {} files ({} copied as-is, {} failed) in {:.2f} s, {:.1f} images/s, {:.1f} MB/s",
+        "log_server": "Local ingest endpoint: http://127.0.0.1:{}/save (token in {})",
+        "log_server_fail": "Local ingest endpoint failed to start: {}",
+        "log_archive": "Saving into archive: {}",
+        "log_recompress": "Recompressed {} in the background: {:.0f} KB → {:.0f} KB, {:.1f} MB saved so far"
     }
 }
 
 # ----------------------------------------------------------
 # 配置 / Configuration
 CONFIG_FILE = pathlib.Path.home() / ".clipboard_saver.json"
+INDEX_FILE = CONFIG_FILE.with_name(".clipboard_saver_index.txt")
+LOG_FILE = CONFIG_FILE.with_name(".clipboard_saver.log")
+PHASH_FILE = CONFIG_FILE.with_name(".clipboard_saver_phash.txt")
+TOKEN_FILE = CONFIG_FILE.with_name(".clipboard_saver_token")
 DEFAULT_DIR = pathlib.Path.home() / "Downloads"
 FORMATS = {"PNG": ("png", True), "JPG": ("jpg", False), "JPEG": ("jpeg", False),
            "BMP": ("bmp", True), "TIFF": ("tiff", True), "WebP": ("webp", False),
            "GIF": ("gif", False)}
+# 缩放速度 -> reducing_gap：先用 reduce() 整数倍缩小，再做最终 LANCZOS；None 为全分辨率 LANCZOS
+# Resize speed -> reducing_gap: integer reduce() pre-pass, then the final LANCZOS; None is full-resolution LANCZOS
+RESIZE_SPEEDS = {"quality": None, "balanced": 3.0, "fast": 2.0, "fastest": 1.0}
 
 # ----------------------------------------------------------
 # 工具函数 / Utility functions
@@ -130,7 +217,25 @@ def resource_path(rel: str) -> pathlib.Path:
 
 def load_config():
     dft = {"last_dir": str(DEFAULT_DIR), "lang": "zh", "quality": 95,
-           "copy_path": True, "override": False, "listen_mode": False}
+           "copy_path": True, "override": False, "listen_mode": False,
+           "clipboard_backend": "auto", "poll_min_ms": 200, "poll_max_ms": 2000,
+           "dedup": True, "save_workers": 2, "save_queue": 8, "save_policy": "drop_oldest",
+           "resample": "fast", "use_profile": False,
+           "metrics_file": "", "metrics_every": 10,
+           "name_template": "{date}_{time}", "fsync": False,
+           "cache_max_mb": 256, "cache_ttl_s": 300,
+           "near_dup": "off", "near_dup_threshold": 4,
+           "memory_budget_mb": 0, "ingest_workers": 4,
+           "server_port": 0, "server_max_mb": 64, "server_require_token": True,
+           "sink": "files", "archive_file": "",
+           "recompress": False, "recompress_idle_s": 2.0, "max_kb": 0,
+           "log_lines": 500, "log_file": str(LOG_FILE), "log_max_kb": 1024, "log_backups": 3,
+           "export_profile": [
+               {"fmt": "PNG"},
+               {"fmt": "JPG", "resize_mode": "long_edge", "long_edge": 1920,
+                "quality": 90, "suffix": "_1920"},
+               {"fmt": "WebP", "resize_mode": "long_edge", "long_edge": 320,
+                "quality": 80, "suffix": "_thumb"}]}
     if CONFIG_FILE.exists():
         try:
             dft.update(json.loads(CONFIG_FILE.read_text(encoding="utf8")))
@@ -138,13 +243,131 @@ def load_config():
             pass
     return dft
 
+def _default_mode():
+    # 进程启动时读一次 umask（os.umask 只能先设再改回） / Read the umask once at start (os.umask can only set-and-restore)
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+FILE_MODE = _default_mode()
+
+
+def atomic_write(path, writer, fsync=False, overwrite=True, mode=None):
+    # 先让 writer(f) 写同目录临时文件再重命名，读者永远看不到半个文件。
+    # overwrite=False 时目标已存在会抛出 FileExistsError（Windows 用 rename，POSIX 用 link）
+    # mkstemp 的临时文件是 0600，重命名前改成 mode（默认沿用被覆盖文件的权限，否则按 umask）
+    # writer(f) fills a temp file in the same directory, then it is renamed: readers never see a
+    # partial file. With overwrite=False an existing target raises FileExistsError
+    # (rename on Windows, link on POSIX). mkstemp makes the temp file 0600, so it is set to `mode`
+    # before the rename (default: the replaced file's mode, else what the umask allows)
+    path = pathlib.Path(path)
+    if mode is None:
+        try:
+            mode = os.stat(path).st_mode & 0o7777 if overwrite else FILE_MODE
+        except OSError:
+            mode = FILE_MODE
+    fd, tmp = tempfile.mkstemp(dir=str(path.parent), prefix="." + path.name + ".", suffix=".tmp")
+    try:
+        os.chmod(tmp, mode)
+        with os.fdopen(fd, "wb") as f:
+            writer(f)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        if overwrite:
+            os.replace(tmp, str(path))
+        elif sys.platform == "win32":
+            os.rename(tmp, str(path))
+        else:
+            try:
+                os.link(tmp, str(path))
+            except FileExistsError:
+                raise
+            except OSError:
+                # 文件系统不支持硬链接（如 FAT） / Filesystem without hard links (e.g. FAT)
+                os.replace(tmp, str(path))
+            else:
+                os.unlink(tmp)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+def atomic_write_bytes(path, data, fsync=False, overwrite=True, mode=None):
+    atomic_write(path, lambda f: f.write(data), fsync, overwrite, mode)
+
 def save_config(cfg):
     try:
-        CONFIG_FILE.write_text(json.dumps(cfg, ensure_ascii=False, indent=2),
-                               encoding="utf8")
+        atomic_write_bytes(CONFIG_FILE, json.dumps(cfg, ensure_ascii=False, indent=2)
+                           .encode("utf8"))
     except Exception as e:
         print("save_config:", e)
 
+
+class ConfigStore:
+    # 配置常驻内存；修改经防抖合并，由定时器串行地原子写盘，退出时 flush()
+    # Config lives in memory; changes are coalesced on a debounce timer and written
+    # atomically one at a time; call flush() on exit
+    def __init__(self, delay=1.0):
+        self.delay = delay
+        self.writes = 0
+        self._data = load_config()
+        self._lock = threading.RLock()
+        self._timer = None
+        self._dirty = False
+
+    def __getitem__(self, key):
+        with self._lock:
+            return self._data[key]
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._data.get(key, default)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._data)
+
+    def update(self, **changes):
+        with self._lock:
+            if all(self._data.get(k) == v for k, v in changes.items()):
+                return
+            self._data.update(changes)
+            self._dirty = True
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._dirty:
+                return
+            self._dirty = False
+            save_config(self._data)
+            self.writes += 1
+
+def init_file_log(path, max_kb=1024, backups=3):
+    # 轮转日志文件，由后台监听线程写盘，不阻塞调用方
+    # Rotating log file written by a background listener thread so callers never block on disk
+    handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_kb * 1024,
+                                                   backupCount=backups, encoding="utf8")
+    handler.setFormatter(logging.Formatter("%(asctime)s  %(message)s"))
+    q = queue.Queue()
+    logger = logging.getLogger("clipimg")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.addHandler(logging.handlers.QueueHandler(q))
+    listener = logging.handlers.QueueListener(q, handler)
+    listener.start()
+    return logger, listener
+
 def get_clipboard_image():
     try:
         return ImageGrab.grabclipboard()
@@ -152,10 +375,1630 @@ def get_clipboard_image():
         return None
 
 # ----------------------------------------------------------
-class App(tk.Tk):
+# 保存引擎（不依赖 Tk，可在工作线程/进程中使用）
+# Save engine (no Tk, safe to use from worker threads and processes)
+class SaveOptions(NamedTuple):
+    directory: str = str(DEFAULT_DIR)
+    name: str = ""
+    fmt: str = "PNG"
+    resize_mode: str = "none"
+    long_edge: int = 1920
+    width: int = 1920
+    height: int = 1080
+    quality: int = 95
+    override: bool = False
+    resample: str = "fast"
+    name_template: str = "{date}_{time}"
+    fsync: bool = False
+    max_kb: int = 0
+
+
+def fit_long_edge(size, long_edge):
+    # 与 Image.thumbnail 一致：只缩小，保持宽高比 / Same as Image.thumbnail: shrink only, keep aspect ratio
+    w, h = size
+    if max(w, h) <= long_edge:
+        return size
+    if w >= h:
+        return long_edge, max(1, round(h * long_edge / w))
+    return max(1, round(w * long_edge / h)), long_edge
+
+
+def target_size(size, opts):
+    if opts.resize_mode == "long_edge":
+        return fit_long_edge(size, opts.long_edge)
+    if opts.resize_mode == "wh":
+        return opts.width, opts.height
+    return size
+
+
+def resize_to(im, size, resample="fast"):
+    return im.resize(size, Image.LANCZOS, reducing_gap=RESIZE_SPEEDS.get(resample, 2.0))
+
+
+def resize_image(im, opts):
+    # 返回新图像，不修改传入的图像 / Returns a new image, never modifies the one passed in
+    size = target_size(im.size, opts)
+    if size == im.size:
+        return im
+    return resize_to(im, size, opts.resample)
+
+
+def encode_args(im, fmt, opts):
+    ext = FORMATS[fmt][0]
+    kw = {}
+    if ext in ("jpg", "jpeg"):
+        if im.mode != "RGB":
+            im = im.convert("RGB")
+        kw["quality"] = opts.quality
+    elif ext == "webp":
+        kw["quality"] = opts.quality
+    return im, kw
+
+
+class NameAllocator:
+    # 每个目录只列一次目录，之后在内存中预留文件名；重名时追加本次运行的序号，无需反复 stat
+    # Lists each directory once, then reserves names in memory; clashes get a per-run
+    # sequence number instead of repeated stat() calls
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._names = {}
+        self._next = {}
+        self._origin = {}
+        self._seq = 0
+
+    def _dir_names(self, d):
+        names = self._names.get(d)
+        if names is None:
+            d.mkdir(parents=True, exist_ok=True)
+            names = self._names[d] = {n.lower() for n in os.listdir(d)}
+        return names
+
+    def next_seq(self):
+        with self._lock:
+            self._seq += 1
+            return self._seq
+
+    def allocate(self, directory, stem, ext, override=False):
+        d = pathlib.Path(directory)
+        with self._lock:
+            names = self._dir_names(d)
+            name = f"{stem}.{ext}"
+            if not override:
+                key = (d, stem.lower(), ext)
+                n = self._next.get(key, 1)
+                while name.lower() in names:
+                    name, n = f"{stem}_{n:03d}.{ext}", n + 1
+                self._next[key] = n
+            names.add(name.lower())
+            path = d / name
+            self._origin[path] = (stem, ext)
+            return path
+
+    def reallocate(self, path):
+        # 目标被外部程序抢先创建时换下一个名字 / Next name when another program created the target first
+        stem, ext = self._origin.pop(path, (path.stem, path.suffix[1:]))
+        return self.allocate(path.parent, stem, ext)
+
+    def commit(self, path):
+        # 写入成功后文件本身占着名字，不再需要改名信息 / Once written the file itself holds the name
+        with self._lock:
+            self._origin.pop(path, None)
+
+    def release(self, path):
+        # 保存失败时归还名字 / Gives the name back after a failed save
+        with self._lock:
+            self._origin.pop(path, None)
+            names = self._names.get(path.parent)
+            if names is not None:
+                names.discard(path.name.lower())
+
+
+NAMES = NameAllocator()
+
+
+def render_name(template, fmt, size=None, now=None):
+    # 可用字段 / Fields: {date} {time} {ms} {seq} {fmt} {w} {h}
+    now = now or datetime.now()
+    w, h = size or (0, 0)
+    return template.format(date=now.strftime("%Y%m%d"), time=now.strftime("%H%M%S"),
+                           ms="{:03d}".format(now.microsecond // 1000),
+                           seq="{:04d}".format(NAMES.next_seq()),
+                           fmt=fmt.lower(), w=w, h=h)
+
+
+def make_output_path(opts, size=None):
+    name = opts.name or render_name(opts.name_template, opts.fmt, size)
+    return NAMES.allocate(opts.directory, name, FORMATS[opts.fmt][0], opts.override)
+
+
+def pil_format(fmt):
+    return Image.registered_extensions()["." + FORMATS[fmt][0]]
+
+
+# 超过此像素字节数的输出直接编码进临时文件，不在内存里再留一份编码结果
+# Outputs above this many pixel bytes are encoded straight into the temp file instead of a memory buffer
+STREAM_ENCODE_BYTES = 32 << 20
+
+
+class MemoryTracker:
+    # 估算一次保存中同时存活的图像/编码缓冲区字节数 / Estimates image and encode buffers alive at once in one save
+    def __init__(self, base=0):
+        self.current = base
+        self.peak = base
+        self._lock = threading.Lock()
+
+    def alloc(self, n):
+        with self._lock:
+            self.current += n
+            self.peak = max(self.peak, self.current)
+
+    def free(self, n):
+        with self._lock:
+            self.current -= n
+
+
+def release(im, keep, mem=None):
+    # 及早关闭引擎自己创建的中间图像 / Eagerly close an intermediate the engine created itself
+    if im is not keep:
+        if mem is not None:
+            mem.free(image_nbytes(im))
+        im.close()
+
+
+def encode_to(f, im, opts, mem=None):
+    enc, kw = encode_args(im, opts.fmt, opts)
+    if mem is not None and enc is not im:
+        mem.alloc(image_nbytes(enc))
+    try:
+        enc.save(f, pil_format(opts.fmt), **kw)
+    finally:
+        release(enc, im, mem)
+
+
+def encode_image(im, opts, mem=None):
+    if size_limited(opts):
+        return encode_to_size(im, opts, mem)
+    buf = io.BytesIO()
+    encode_to(buf, im, opts, mem)
+    if mem is not None:
+        mem.alloc(buf.tell())
+    return buf.getbuffer()
+
+
+# 体积上限模式：为 JPG/WebP 找到不超过 max_kb 的最高质量
+# Size-limit mode: find the highest JPG/WebP quality that fits in max_kb
+MIN_QUALITY = 10
+
+
+# 只有这些格式的 quality 会改变体积（GIF 没有质量参数） / Only these formats' quality changes the size (GIF has none)
+SIZE_LIMIT_EXTS = ("jpg", "jpeg", "webp")
+
+
+def size_limited(opts):
+    return opts.max_kb > 0 and FORMATS[opts.fmt][0] in SIZE_LIMIT_EXTS
+
+
+class QualityHints:
+    # 按格式、上限和像素量（半个数量级一档）记住原尺寸下上次选中的质量，后续截图从附近开始搜索
+    # Remembers the quality chosen at full size per format, limit and pixel-count bucket (half
+    # an octave) so later captures start searching close to the answer
+    def __init__(self, limit=256):
+        self.limit = limit
+        self._hints = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(size, opts):
+        return opts.fmt, opts.max_kb, opts.quality, round(math.log2(max(1, size[0] * size[1])) * 2)
+
+    def get(self, size, opts):
+        with self._lock:
+            return self._hints.get(self.key(size, opts))
+
+    def put(self, size, opts, quality):
+        with self._lock:
+            key = self.key(size, opts)
+            self._hints[key] = quality
+            self._hints.move_to_end(key)
+            while len(self._hints) > self.limit:
+                self._hints.popitem(last=False)
+
+
+QUALITY_HINTS = QualityHints()
+
+
+def _encode_quality(enc, fmt, kw, quality):
+    buf = io.BytesIO()
+    enc.save(buf, fmt, **{**kw, "quality": quality})
+    return buf
+
+
+def search_quality(enc, opts, kw, hint=None, ways=3):
+    # 多路二分：每轮并行编码 ways 个候选，区间缩小到约 1/(ways+1)；有提示时先试提示值附近
+    # 返回 (质量, 缓冲区, 是否装下)；装不下时为最低质量的结果
+    # k-way bisection: each round encodes `ways` candidates in parallel, shrinking the range to
+    # ~1/(ways+1); a hint is tried first. Returns (quality, buffer, fits); when nothing fits the
+    # buffer is the MIN_QUALITY encode
+    limit = opts.max_kb * 1024
+    fmt = pil_format(opts.fmt)
+    top = max(MIN_QUALITY, min(100, opts.quality))
+    lo, hi = MIN_QUALITY - 1, top + 1      # lo 及以下都装得下，hi 及以上都装不下 / everything <= lo fits, >= hi does not
+    best = smallest = None
+    # 首轮同时试最高、最低和提示值（无提示时取中点），尽早确定区间
+    # The first round tries the top, the bottom and the hint (or the midpoint) to bound the range early
+    cands = [top, MIN_QUALITY] + ([hint, hint + 1] if hint else [(top + MIN_QUALITY) // 2])
+    while hi - lo > 1:
+        cands = sorted({q for q in cands if lo < q < hi})
+        if not cands:
+            step = (hi - lo) / (ways + 1)
+            cands = sorted({min(hi - 1, max(lo + 1, round(lo + step * i)))
+                            for i in range(1, ways + 1)})
+        futs = [(q, shared_pool("search").submit(_encode_quality, enc, fmt, kw, q))
+                for q in cands]
+        for q, fut in futs:
+            buf = fut.result()
+            if buf.tell() <= limit:
+                if q > lo:
+                    lo, best = q, buf
+            elif q < hi:
+                hi = q
+                if q == MIN_QUALITY:
+                    smallest = buf
+        cands = []
+    if best is not None:
+        return lo, best, True
+    return MIN_QUALITY, smallest, False
+
+
+def encode_to_size(im, opts, mem=None):
+    enc, kw = encode_args(im, opts.fmt, opts)
+    if mem is not None and enc is not im:
+        mem.alloc(image_nbytes(enc))
+    limit = opts.max_kb * 1024
+    # 提示只作为质量搜索的起点：总是先试原尺寸，最低质量仍超限才缩小
+    # The hint only seeds the quality search: full size is always tried first and the image is
+    # shrunk only after a real miss at the lowest quality
+    hint = QUALITY_HINTS.get(enc.size, opts)
+    cur = enc
+    try:
+        while True:
+            quality, buf, fits = search_quality(cur, opts, kw, hint)
+            if fits:
+                if cur is enc:
+                    QUALITY_HINTS.put(enc.size, opts, quality)
+                break
+            # 最低质量仍超出上限：按体积比例缩小后重试 / Too large even at the lowest quality:
+            # shrink by the size ratio and search again
+            ratio = min(0.9, math.sqrt(limit / buf.tell()) * 0.95)
+            size = max(1, round(cur.width * ratio)), max(1, round(cur.height * ratio))
+            if min(cur.size) <= 16:
+                break
+            smaller = resize_to(cur, size, opts.resample)
+            if mem is not None:
+                mem.alloc(image_nbytes(smaller))
+            release(cur, enc, mem)
+            cur, hint = smaller, None
+    finally:
+        release(cur, enc, mem)
+        release(enc, im, mem)
+    if mem is not None:
+        mem.alloc(buf.tell())
+    return buf.getbuffer()
+
+
+def write_file(path, data, opts):
+    # 原子写入，data 可以是字节或 writer(f)；返回实际路径（目标被占用时改名重试）
+    # Atomic write of bytes or a writer(f); returns the real path (renamed if the target was taken)
+    path = pathlib.Path(path)
+    writer = data if callable(data) else (lambda f: f.write(data))
+    while True:
+        try:
+            atomic_write(path, writer, opts.fsync, opts.override)
+        except FileExistsError:
+            path = NAMES.reallocate(path)
+            continue
+        except BaseException:
+            NAMES.release(path)
+            raise
+        NAMES.commit(path)
+        return path
+
+
+class FileSink:
+    # 默认输出：每张图一个文件 / Default output: one file per image
+    name = "files"
+
+    def output_path(self, opts, size=None):
+        return make_output_path(opts, size)
+
+    def write(self, path, data, opts, size=None, fingerprint=None):
+        return write_file(path, data, opts)
+
+    def close(self):
+        pass
+
+
+FILES = FileSink()
+
+
+def lap(timings, stage, t0):
+    # 累加阶段耗时（毫秒），返回新的起点 / Adds the stage time in ms and returns the new start time
+    t1 = time.perf_counter()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + (t1 - t0) * 1000
+    return t1
+
+
+def save_image_file(im, path, opts, timings=None, mem=None, owned=False, sink=None,
+                    fingerprint=None):
+    # path 为 None 时按缩放后的尺寸分配文件名；owned=True 表示调用方不再使用 im，缩放后即释放
+    # With path=None a name is allocated from the resized image; owned=True means the caller
+    # is done with im, so it is released as soon as the resized copy exists
+    sink = sink or FILES
+    t = time.perf_counter()
+    out = resize_image(im, opts)
+    if out is not im:
+        if mem is not None:
+            mem.alloc(image_nbytes(out))
+        if owned:
+            release(im, None, mem)
+    t = lap(timings, "resize", t)
+    path = path or sink.output_path(opts, out.size)
+    try:
+        if image_nbytes(out) > STREAM_ENCODE_BYTES and not size_limited(opts):
+            # 大图边编码边写入，编码与写盘合计为 encode / Large images stream; encode covers the write too
+            path = sink.write(path, lambda f: encode_to(f, out, opts, mem), opts, out.size,
+                              fingerprint)
+            lap(timings, "encode", t)
+        else:
+            data = encode_image(out, opts, mem)
+            t = lap(timings, "encode", t)
+            path = sink.write(path, data, opts, out.size, fingerprint)
+            lap(timings, "write", t)
+            if mem is not None:
+                mem.free(len(data))
+    except BaseException:
+        NAMES.release(path)
+        raise
+    finally:
+        if out is not im or owned:
+            release(out, None, mem)
+    return path
+
+
+def estimate_save_bytes(im, opts, targets=None):
+    # 一次保存的峰值估算：源图 + 各缩放结果 + JPG 的 RGB 副本 + 编码缓冲（按原始大小上限）
+    # Peak estimate for one save: source + each resized output + RGB copy for JPG + encode buffer (raw size bound)
+    total = image_nbytes(im)
+    for t in targets or [opts]:
+        w, h = target_size(im.size, t)
+        bands = len(im.getbands())
+        out = w * h * bands if (w, h) != im.size else 0
+        jpg = FORMATS[t.fmt][0] in ("jpg", "jpeg") and im.mode != "RGB"
+        total += out + (w * h * 3 if jpg else 0) + w * h * bands
+    return total
+
+
+class MemoryBudget:
+    # 所有进行中的保存共享一个内存预算；放不下时排队等待，单张超过预算直接拒绝
+    # One budget shared by all saves in flight; saves that do not fit wait, single captures over budget are refused
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, n, timeout=None):
+        if n > self.limit:
+            return False
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.used + n <= self.limit, timeout):
+                return False
+            self.used += n
+            return True
+
+    def release(self, n):
+        with self._cond:
+            self.used -= n
+            self._cond.notify_all()
+
+# ----------------------------------------------------------
+# 多目标导出 / Multi-target export
+# 一次解码，按尺寸从大到小级联缩放（小图由较大的中间结果派生），各目标并行编码
+# Decode once, resize in a cascade from largest to smallest (smaller outputs are derived
+# from larger intermediates) and encode the independent targets in parallel
+class ExportTarget(NamedTuple):
+    fmt: str = "PNG"
+    resize_mode: str = "none"
+    long_edge: int = 1920
+    width: int = 1920
+    height: int = 1080
+    quality: int = 95
+    suffix: str = ""
+    max_kb: int = 0
+
+
+def load_profile(entries):
+    targets = []
+    for entry in entries or ():
+        t = ExportTarget(**{k: v for k, v in entry.items() if k in ExportTarget._fields})
+        if t.fmt in FORMATS:
+            targets.append(t)
+    return targets
+
+
+def describe_profile(targets):
+    parts = []
+    for t in targets:
+        if t.resize_mode == "long_edge":
+            parts.append(f"{t.fmt}@{t.long_edge}")
+        elif t.resize_mode == "wh":
+            parts.append(f"{t.fmt}@{t.width}x{t.height}")
+        else:
+            parts.append(t.fmt)
+    return ", ".join(parts)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def shared_pool(name):
+    # 按用途分开的线程池：在一个池的任务里等待另一个池，不会互相占满而死锁
+    # One pool per purpose, so a task waiting on another pool can never starve it into a deadlock
+    with _pools_lock:
+        pool = _pools.get(name)
+        if pool is None:
+            pool = _pools[name] = ThreadPoolExecutor(max_workers=os.cpu_count() or 2,
+                                                     thread_name_prefix=name)
+        return pool
+
+
+def _reset_pools():
+    # fork 出的子进程继承了池对象但没有其中的线程 / A forked child inherits the pools but not their threads
+    global _pools_lock
+    _pools.clear()
+    _pools_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_pools)
+
+
+def encode_pool():
+    return shared_pool("encode")
+
+
+def _encode_target(im, path, opts, mem=None, sink=FILES, fingerprint=None):
+    timings = {}
+    t = time.perf_counter()
+    try:
+        data = encode_image(im, opts, mem)
+    except BaseException:
+        NAMES.release(path)
+        raise
+    t = lap(timings, "encode", t)
+    path = sink.write(path, data, opts, im.size, fingerprint)
+    lap(timings, "write", t)
+    if mem is not None:
+        mem.free(len(data))
+    return path, timings
+
+
+class ExportError(Exception):
+    # 部分目标失败：paths 为已写出的结果，__cause__ 为第一个错误
+    # Some targets failed: paths holds the ones that were written, __cause__ the first error
+    def __init__(self, error, paths):
+        super().__init__(str(error))
+        self.paths = paths
+
+
+def export_targets(im, opts, targets, timings=None, mem=None, owned=False, sink=None,
+                   fingerprint=None):
+    # opts 提供目录、文件名和覆盖选项；每个目标覆盖格式/尺寸/质量
+    # opts supplies directory, name and override; each target overrides format/size/quality
+    sink = sink or FILES
+    name = opts.name or render_name(opts.name_template, opts.fmt, im.size)
+    jobs = []
+    for t in targets:
+        t_opts = opts._replace(name=name + t.suffix, fmt=t.fmt, resize_mode=t.resize_mode,
+                               long_edge=t.long_edge, width=t.width, height=t.height,
+                               quality=t.quality, max_kb=t.max_kb)
+        jobs.append((target_size(im.size, t_opts), t_opts, sink.output_path(t_opts)))
+
+    # 只有保持宽高比的结果才能作为后续缩放的来源 / Only aspect-preserving results may feed later resizes
+    sources, created = [im], []
+    futures = [None] * len(jobs)
+    order = sorted(range(len(jobs)), key=lambda i: -jobs[i][0][0] * jobs[i][0][1])
+    paths, error = [], None
+    try:
+        for i in order:
+            size, t_opts, path = jobs[i]
+            src = min((s for s in sources if s.width >= size[0] and s.height >= size[1]),
+                      key=lambda s: s.width * s.height, default=im)
+            t = time.perf_counter()
+            out = src if src.size == size else resize_to(src, size, t_opts.resample)
+            lap(timings, "resize", t)
+            if out is not src:
+                created.append(out)
+                if mem is not None:
+                    mem.alloc(image_nbytes(out))
+            if t_opts.resize_mode != "wh":
+                sources.append(out)
+            futures[i] = encode_pool().submit(_encode_target, out, path, t_opts, mem, sink,
+                                              fingerprint)
+    except BaseException as e:
+        error = e
+        # 未提交的目标归还预留的名字 / Targets never submitted give their reserved names back
+        for (_, _, path), f in zip(jobs, futures):
+            if f is None:
+                NAMES.release(path)
+    try:
+        # 等所有已提交的目标结束，一个失败不能丢下其他已写出的文件
+        # Wait for every submitted target, so one failure does not orphan files the others wrote
+        for f in futures:
+            if f is None:
+                continue
+            try:
+                path, t_timings = f.result()
+            except BaseException as e:
+                error = error or e
+                continue
+            paths.append(path)
+            if timings is not None:
+                for stage, ms in t_timings.items():
+                    timings[stage] = timings.get(stage, 0.0) + ms
+    finally:
+        # 释放中间结果（以及调用方交出的源图） / Release intermediates (and the source if the caller handed it over)
+        for out in created + ([im] if owned else []):
+            release(out, None, mem)
+    if error is not None:
+        if paths and isinstance(error, Exception):
+            raise ExportError(error, paths) from error
+        raise error
+    return paths
+
+# ----------------------------------------------------------
+# 归档输出 / Archive sink
+# 长时间监听时把截图追加进单个 SQLite 会话文件，代替成千上万个小文件
+# For long listen sessions captures are appended to one SQLite session file instead of
+# thousands of small files; exported back to files on demand
+class ArchiveSink:
+    name = "archive"
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS images (
+            id INTEGER PRIMARY KEY, ts REAL NOT NULL, name TEXT NOT NULL,
+            format TEXT NOT NULL, width INTEGER, height INTEGER, fingerprint TEXT,
+            data BLOB NOT NULL);
+        CREATE INDEX IF NOT EXISTS images_ts ON images(ts);
+        CREATE INDEX IF NOT EXISTS images_fingerprint ON images(fingerprint);
+    """
+
+    def __init__(self, path, fsync=False):
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        # WAL 下每次追加只顺序写日志 / In WAL mode each append is a sequential log write
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=" + ("FULL" if fsync else "NORMAL"))
+        self._db.executescript(self.SCHEMA)
+
+    @staticmethod
+    def session_path(directory):
+        return pathlib.Path(directory) / f"clipimg_{datetime.now():%Y%m%d_%H%M%S}.sqlite"
+
+    def ref(self, rowid):
+        # 归档内图片的“路径”，用于日志、去重索引和复制路径 / Stands in for a file path in logs, the index and copy_path
+        return pathlib.Path(f"{self.path}#{rowid}")
+
+    @staticmethod
+    def has_ref(ref):
+        # ref 是否指向仍存在的归档条目（只读打开，不影响正在写入的会话）
+        # Whether ref names an archive entry that still exists (opened read-only, safe beside a live session)
+        archive, sep, rowid = str(ref).rpartition("#")
+        if not sep or not rowid.isdigit() or not os.path.isfile(archive):
+            return False
+        try:
+            db = sqlite3.connect(pathlib.Path(archive).resolve().as_uri() + "?mode=ro", uri=True)
+            try:
+                return db.execute("SELECT 1 FROM images WHERE id = ?",
+                                  (int(rowid),)).fetchone() is not None
+            finally:
+                db.close()
+        except sqlite3.Error:
+            return False
+
+    def output_path(self, opts, size=None):
+        name = opts.name or render_name(opts.name_template, opts.fmt, size)
+        return pathlib.Path(name + "." + FORMATS[opts.fmt][0])
+
+    def write(self, path, data, opts, size=None, fingerprint=None):
+        if callable(data):
+            buf = io.BytesIO()
+            data(buf)
+            data = buf.getbuffer()
+        w, h = size or (None, None)
+        with self._lock, self._db:
+            cur = self._db.execute(
+                "INSERT INTO images (ts, name, format, width, height, fingerprint, data) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), pathlib.Path(path).name, opts.fmt, w, h, fingerprint, data))
+        return self.ref(cur.lastrowid)
+
+    def entries(self, ids=None, since=None, fingerprint=None):
+        sql = "SELECT id, ts, name, format, width, height, fingerprint, length(data) FROM images"
+        where, args = [], []
+        if ids:
+            where.append("id IN ({})".format(",".join("?" * len(ids))))
+            args += list(ids)
+        if since is not None:
+            where.append("ts >= ?")
+            args.append(since)
+        if fingerprint:
+            where.append("fingerprint = ?")
+            args.append(fingerprint)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        with self._lock:
+            return self._db.execute(sql + " ORDER BY id", args).fetchall()
+
+    def export(self, directory, ids=None, since=None, fingerprint=None, override=False):
+        # 逐条读取数据，按原名写出（同名时自动编号） / Reads one blob at a time; keeps the stored name, numbered on clashes
+        opts = SaveOptions(directory=str(directory), override=override)
+        paths = []
+        for rowid, _, name, *_ in self.entries(ids, since, fingerprint):
+            with self._lock:
+                data = self._db.execute("SELECT data FROM images WHERE id = ?",
+                                        (rowid,)).fetchone()[0]
+            name = pathlib.Path(name)
+            path = NAMES.allocate(directory, name.stem, name.suffix.lstrip("."), override)
+            paths.append(write_file(path, data, opts))
+        return paths
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+# ----------------------------------------------------------
+# 阶段耗时统计 / Per-stage timing
+# 每个阶段保留最近 window 个样本，给出 p50/p95/max；可选把每次保存写成一行 JSON
+# Keeps the last `window` samples per stage for p50/p95/max; optionally writes one JSON line per save
+STAGES = ("grab", "fingerprint", "phash", "resize", "encode", "write", "config", "copy_path")
+
+
+class StageMetrics:
+    def __init__(self, window=256, path=None):
+        self.window = window
+        self.path = path
+        self._samples = {}
+        self._lock = threading.Lock()
+        self._file = None
+
+    def observe(self, stage, ms):
+        with self._lock:
+            if stage not in self._samples:
+                self._samples[stage] = deque(maxlen=self.window)
+            self._samples[stage].append(ms)
+
+    def summary(self):
+        out = {}
+        with self._lock:
+            items = [(k, sorted(v)) for k, v in self._samples.items() if v]
+        for stage, xs in items:
+            out[stage] = {"n": len(xs), "p50": xs[(len(xs) - 1) // 2],
+                          "p95": xs[min(len(xs) - 1, int(len(xs) * 0.95))], "max": xs[-1]}
+        return out
+
+    def format_summary(self):
+        summ = self.summary()
+        order = [s for s in STAGES if s in summ] + sorted(set(summ) - set(STAGES))
+        return " | ".join("{} p50 {:.1f} p95 {:.1f} max {:.1f} ms".format(
+            s, summ[s]["p50"], summ[s]["p95"], summ[s]["max"]) for s in order)
+
+    def emit(self, record):
+        if not self.path:
+            return
+        line = json.dumps({"ts": round(time.time(), 3), **record}, ensure_ascii=False)
+        with self._lock:
+            try:
+                if self._file is None:
+                    self._file = open(self.path, "a", encoding="utf8")
+                self._file.write(line + "\n")
+                self._file.flush()
+            except OSError as e:
+                print("StageMetrics:", e)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+# ----------------------------------------------------------
+# 内容指纹 / Content fingerprint
+def image_fingerprint(im, strip_bytes=1 << 22):
+    # 按条带把像素流式送入哈希，不复制整幅缓冲区
+    # Streams the pixel buffer through the hash strip by strip instead of copying it whole
+    h = xxhash.xxh3_128() if xxhash else hashlib.sha1()
+    w, ht = im.size
+    rows = max(1, strip_bytes // max(1, w * len(im.getbands())))
+    for y in range(0, ht, rows):
+        h.update(im.crop((0, y, w, min(y + rows, ht))).tobytes())
+    if im.mode == "P":
+        h.update(bytes(im.getpalette() or ()))
+    return "{}:{}x{}:{}".format(im.mode, w, ht, h.hexdigest())
+
+
+class SavedIndex:
+    # 已保存内容的磁盘索引（每行 指纹\t路径，追加写），跨重启去重
+    # On-disk index of saved content (append-only "fingerprint\tpath" lines), dedups across restarts
+    def __init__(self, path=INDEX_FILE, limit=10000):
+        self.path = pathlib.Path(path)
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._lines = 0
+        try:
+            lines = self.path.read_text(encoding="utf8").splitlines()
+        except OSError:
+            lines = []
+        for line in lines:
+            fp, _, saved = line.partition("\t")
+            if fp:
+                self._entries.pop(fp, None)
+                self._entries[fp] = saved
+        self._lines = len(lines)
+        self._trim()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, fp):
+        # 原文件（或归档中的条目）已被删除则不算重复
+        # Not a duplicate if the saved file (or archive entry) has since been deleted
+        saved = self._entries.get(fp)
+        if saved and (os.path.exists(saved) or ArchiveSink.has_ref(saved)):
+            return saved
+        return None
+
+    def add(self, fp, path):
+        with self._lock:
+            self._entries.pop(fp, None)
+            self._entries[fp] = str(path)
+            try:
+                with self.path.open("a", encoding="utf8") as f:
+                    f.write("{}\t{}\n".format(fp, path))
+                self._lines += 1
+            except OSError as e:
+                print("SavedIndex:", e)
+            self._trim()
+
+    def _trim(self):
+        while len(self._entries) > self.limit:
+            self._entries.popitem(last=False)
+        # 日志行数远超条目数时重写压缩 / Compact the file once it holds far more lines than entries
+        if self._lines > 2 * max(self.limit, len(self._entries)):
+            try:
+                self.path.write_text("".join("{}\t{}\n".format(k, v)
+                                             for k, v in self._entries.items()),
+                                     encoding="utf8")
+                self._lines = len(self._entries)
+            except OSError as e:
+                print("SavedIndex:", e)
+
+# ----------------------------------------------------------
+# 保存线程池 / Save executor
+# 固定数量的工作线程 + 有界队列。队列满时：
+#   drop_oldest 丢弃最旧的排队任务；coalesce 用新任务替换最新的排队任务；
+#   block 由生产者（监视线程）暂停抓取形成背压，submit 本身从不阻塞 Tk 线程。
+# Fixed worker threads + bounded queue. When the queue is full:
+#   drop_oldest evicts the oldest queued job; coalesce replaces the newest queued job;
+#   block pauses the producer (the monitor) instead, submit itself never blocks the Tk thread.
+class SaveExecutor:
+    POLICIES = ("drop_oldest", "coalesce", "block")
+
+    def __init__(self, workers=2, max_queue=8, policy="drop_oldest", on_change=None):
+        self.max_queue = max(1, max_queue)
+        self.policy = policy if policy in self.POLICIES else "drop_oldest"
+        self.on_change = on_change
+        self.in_flight = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.done = 0
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._threads = [threading.Thread(target=self._worker, daemon=True)
+                         for _ in range(max(1, workers))]
+        for t in self._threads:
+            t.start()
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    def full(self):
+        return len(self._pending) >= self.max_queue
+
+    def busy(self):
+        return bool(self._pending) or self.in_flight > 0
+
+    def stats(self):
+        return {"depth": self.depth, "in_flight": self.in_flight, "done": self.done,
+                "dropped": self.dropped, "coalesced": self.coalesced}
+
+    def submit(self, fn, *args, key=None, force=False):
+        # force：手动保存总是入队 / force: manual saves are always queued
+        fut = Future()
+        job = (key, fut, fn, args)
+        event = None
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("executor is shut down")
+            for i, (k, old, _, _) in enumerate(self._pending):
+                if key is not None and k == key:
+                    # 相同内容已在排队 / Same content already queued
+                    self._pending[i] = job
+                    old.cancel()
+                    self.coalesced += 1
+                    event = "coalesce"
+                    break
+            else:
+                if self.full() and not force and self.policy != "block":
+                    if self.policy == "coalesce":
+                        old = self._pending.pop()[1]
+                        self.coalesced += 1
+                    else:
+                        old = self._pending.popleft()[1]
+                        self.dropped += 1
+                    old.cancel()
+                    event = self.policy
+                self._pending.append(job)
+            self._cond.notify()
+        self._changed(event)
+        return fut
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                _, fut, fn, args = self._pending.popleft()
+                self.in_flight += 1
+            self._changed()
+            if fut.set_running_or_notify_cancel():
+                try:
+                    fut.set_result(fn(*args))
+                except BaseException as e:
+                    fut.set_exception(e)
+            with self._cond:
+                self.in_flight -= 1
+                self.done += 1
+                self._cond.notify_all()
+            self._changed()
+
+    def _changed(self, event=None):
+        if self.on_change:
+            try:
+                self.on_change(event, self.stats())
+            except Exception as e:
+                print("SaveExecutor:", e)
+
+    def shutdown(self, wait=True, timeout=5.0):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if wait:
+            deadline = time.monotonic() + timeout
+            for t in self._threads:
+                t.join(max(0.0, deadline - time.monotonic()))
+
+# ----------------------------------------------------------
+# 后台重新压缩 / Background recompression
+# 交互路径用 Pillow 默认参数快速写出 PNG/TIFF，空闲时以最低优先级用最高压缩重新编码，
+# 只有变小才原子替换
+# The interactive path writes PNG/TIFF quickly with Pillow defaults; when idle, a lowest-priority
+# thread re-encodes them at maximum compression and atomically replaces them only if smaller
+RECOMPRESS_ARGS = {"png": {"optimize": True},
+                   "tiff": {"compression": "tiff_adobe_deflate"}}
+
+
+def lower_thread_priority():
+    try:
+        if sys.platform == "win32":
+            from ctypes import windll
+            windll.kernel32.SetThreadPriority(windll.kernel32.GetCurrentThread(), -15)  # IDLE
+        elif sys.platform.startswith("linux"):
+            # 只有 Linux 的 nice 值按线程生效；其他系统的线程 id 不是进程号，不能这样调用
+            # Only Linux applies niceness per thread; elsewhere a thread id is not a pid
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+    except (OSError, AttributeError):
+        pass
+
+
+def recompress_file(path, fsync=False):
+    # 返回 (原大小, 新大小)；文件在编码期间被改动时不替换
+    # Returns (old size, new size); a file modified during the encode is left alone
+    path = pathlib.Path(path)
+    kw = RECOMPRESS_ARGS.get(path.suffix.lower().lstrip("."))
+    st = os.stat(path)
+    if kw is None:
+        return st.st_size, st.st_size
+    with Image.open(path) as im:
+        buf = io.BytesIO()
+        im.save(buf, im.format, **kw)
+    now = os.stat(path)
+    if buf.tell() >= st.st_size or (now.st_size, now.st_mtime_ns) != (st.st_size, st.st_mtime_ns):
+        return st.st_size, st.st_size
+    atomic_write_bytes(path, buf.getbuffer(), fsync)
+    return st.st_size, buf.tell()
+
+
+class Recompressor(threading.Thread):
+    def __init__(self, busy, idle_s=2.0, on_done=None, fsync=False, limit=1000):
+        super().__init__(daemon=True)
+        self.busy = busy
+        self.idle_s = idle_s
+        self.on_done = on_done
+        self.fsync = fsync
+        self.saved_bytes = 0
+        self.files = 0
+        self._pending = deque(maxlen=limit)
+        self._cond = threading.Condition()
+        self._last_busy = time.monotonic()
+        self._stopped = False
+
+    def add(self, path):
+        if pathlib.Path(path).suffix.lower().lstrip(".") in RECOMPRESS_ARGS:
+            with self._cond:
+                self._pending.append(path)
+                self._cond.notify()
+
+    def touch(self):
+        # 有新截图时推迟后台工作 / A new capture postpones background work
+        self._last_busy = time.monotonic()
+
+    def _wait_idle(self):
+        # 保存队列空闲且持续 idle_s 秒后才开始下一个文件 / Start the next file only after idle_s seconds without saves
+        while not self._stopped:
+            if self.busy():
+                self._last_busy = time.monotonic()
+            left = self._last_busy + self.idle_s - time.monotonic()
+            if left <= 0:
+                return True
+            with self._cond:
+                self._cond.wait(min(left, 0.5))
+        return False
+
+    def run(self):
+        lower_thread_priority()
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+            if not self._wait_idle():
+                return
+            with self._cond:
+                path = self._pending.popleft()
+            try:
+                before, after = recompress_file(path, self.fsync)
+            except (OSError, ValueError) as e:
+                print("Recompressor:", e)
+                continue
+            if after < before:
+                self.saved_bytes += before - after
+                self.files += 1
+                if self.on_done:
+                    self.on_done(path, before, after)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+# ----------------------------------------------------------
+# 感知哈希近似去重 / Perceptual-hash near-duplicate filter
+def gray_thumb(im, size):
+    # 先整数倍 reduce 到目标的约 4 倍，再转灰度，避免全尺寸灰度副本
+    # Integer reduce() to ~4x the target first, then grayscale, so no full-size gray copy is made
+    if im.mode not in ("L", "LA", "RGB", "RGBA", "RGBX", "I", "F"):
+        im = im.convert("RGB")
+    f = max(1, min(im.width // (size[0] * 4), im.height // (size[1] * 4)))
+    if f > 1:
+        im = im.reduce(f)
+    return im.convert("L").resize(size, Image.BOX)
+
+
+def _bits_to_int(bits):
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), "big")
+
+
+def dhash(im):
+    a = np.asarray(gray_thumb(im, (9, 8)), dtype=np.int16)
+    return _bits_to_int(a[:, 1:] > a[:, :-1])
+
+
+_DCT32 = None
+
+
+def phash(im):
+    global _DCT32
+    if _DCT32 is None:
+        n = np.arange(32)
+        _DCT32 = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / 64)
+    a = np.asarray(gray_thumb(im, (32, 32)), dtype=np.float64)
+    low = (_DCT32 @ a @ _DCT32.T)[:8, :8]
+    return _bits_to_int(low > np.median(low.ravel()[1:]))
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    # 按汉明距离组织的 BK 树，查找半径内的最近邻无需扫描全部历史
+    # BK-tree over Hamming distance: nearest neighbour within a radius without scanning all history
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, h):
+        if self.root is None:
+            self.root = (h, {})
+            self.size = 1
+            return True
+        node = self.root
+        while True:
+            d = hamming(h, node[0])
+            if d == 0:
+                return False
+            child = node[1].get(d)
+            if child is None:
+                node[1][d] = (h, {})
+                self.size += 1
+                return True
+            node = child
+
+    def nearest(self, h, radius):
+        best = None
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            value, children = stack.pop()
+            d = hamming(h, value)
+            if d <= radius and (best is None or d < best[0]):
+                best = (d, value)
+                if d == 0:
+                    break
+            lo, hi = d - radius, d + radius
+            stack.extend(c for k, c in children.items() if lo <= k <= hi)
+        return best
+
+
+class PerceptualFilter:
+    # 哈希历史以追加方式保存在配置文件旁，启动时重建 BK 树
+    # Hash history is appended to a file next to the config and rebuilt into a BK-tree on start
+    HASHES = {"dhash": dhash, "phash": phash}
+
+    def __init__(self, method="dhash", threshold=4, path=PHASH_FILE, limit=20000):
+        self.hash_fn = self.HASHES[method]
+        self.method = method
+        self.threshold = threshold
+        self.path = pathlib.Path(path)
+        self.skipped = 0
+        self.tree = BKTree()
+        self._pending = []
+        self._lock = threading.Lock()
+        try:
+            lines = self.path.read_text(encoding="utf8").split()
+        except OSError:
+            lines = []
+        prefix = method + ":"
+        for line in lines[-limit:]:
+            if line.startswith(prefix):
+                self.tree.add(int(line[len(prefix):], 16))
+
+    def nearest(self, im):
+        # 返回 (哈希, 最近的匹配距离或 None)。无匹配时哈希先登记为保存中，并发的近似截图同样会被跳过；
+        # 保存成功后调用 add()，失败则调用 discard()，历史里只记录真正保存过的内容
+        # Returns (hash, distance of the nearest match or None). Without a match the hash is held
+        # as pending so concurrent near-duplicates are skipped too; call add() once the save
+        # succeeded or discard() if it did not, so only saved content enters the history
+        h = self.hash_fn(im)
+        with self._lock:
+            match = self.tree.nearest(h, self.threshold)
+            dists = [d for d in (hamming(h, p) for p in self._pending) if d <= self.threshold]
+            if match is not None:
+                dists.append(match[0])
+            if dists:
+                self.skipped += 1
+                return h, min(dists)
+            self._pending.append(h)
+        return h, None
+
+    def add(self, h):
+        with self._lock:
+            self._pending.remove(h)
+            if self.tree.add(h):
+                try:
+                    with self.path.open("a", encoding="utf8") as f:
+                        f.write("{}:{:016x}\n".format(self.method, h))
+                except OSError as e:
+                    print("PerceptualFilter:", e)
+
+    def discard(self, h):
+        with self._lock:
+            self._pending.remove(h)
+
+
+def image_nbytes(im):
+    return im.width * im.height * len(im.getbands())
+
+
+class CaptureCache:
+    # 单槽缓存：最近一次解码的截图、指纹和抓取时的剪贴板序号，供按钮/热键保存直接使用。
+    # 超过 max_bytes 的图片只记指纹不留像素；闲置超过 ttl 秒后释放。
+    # Single slot holding the most recent decoded capture, its fingerprint and the clipboard
+    # sequence it was grabbed at, for button and hotkey saves. Images above max_bytes keep only
+    # the fingerprint; idle entries expire after ttl s.
+    def __init__(self, max_bytes=256 << 20, ttl=300.0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._im = None
+        self._fp = None
+        self._seq = None
+        self._used = 0.0
+
+    def put(self, im, fp, seq=None):
+        with self._lock:
+            keep = im is not None and image_nbytes(im) <= self.max_bytes
+            self._im = im if keep else None
+            self._fp = fp
+            self._seq = seq
+            self._used = time.monotonic()
+
+    def confirm(self, fp, seq):
+        # 剪贴板序号变了但内容相同：缓存仍然是最新的 / New sequence, same content: the entry is still current
+        with self._lock:
+            if fp == self._fp:
+                self._seq = seq
+
+    def get(self):
+        with self._lock:
+            self._expire()
+            if self._im is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._used = time.monotonic()
+            return self._im, self._fp, self._seq
+
+    def sweep(self):
+        with self._lock:
+            self._expire()
+
+    def _expire(self):
+        if self._im is not None and self.ttl and time.monotonic() - self._used > self.ttl:
+            self._im = None
+
+    def clear(self):
+        self.put(None, None)
+
+# ----------------------------------------------------------
+# 剪贴板监视后端 / Clipboard watcher backends
+# changed() 必须廉价（序号/事件计数），只有它返回 True 时才调用 grab() 解码图片
+# changed() must be cheap (sequence number / event count); grab() decodes only after it returns True
+class ClipboardWatcher:
+    name = "poll"
+    # 没有序号的后端为 None / None for backends without a sequence number
+    counter = None
+    last_seq = None
+
+    def changed(self):
+        # 无法廉价检测时退化为每次都抓取 / No cheap check available: grab every tick
+        return True
+
+    def grab(self):
+        return get_clipboard_image()
+
+    def close(self):
+        pass
+
+
+class CounterWatcher(ClipboardWatcher):
+    # counter() 返回剪贴板序号/事件计数，None 表示暂时无法判断 / counter() returns a sequence or event count, None if unknown
+    def __init__(self, counter):
+        self.counter = counter
+        self._seen = None
+
+    @property
+    def last_seq(self):
+        # changed() 最近一次读到的序号 / The sequence changed() read last
+        return self._seen
+
+    def changed(self):
+        seq = self.counter()
+        if seq is not None and seq == self._seen:
+            return False
+        self._seen = seq
+        return True
+
+
+class Win32Watcher(CounterWatcher):
+    name = "win32"
+
+    def __init__(self):
+        from ctypes import windll
+        super().__init__(windll.user32.GetClipboardSequenceNumber)
+
+
+class MacWatcher(CounterWatcher):
+    name = "macos"
+
+    def __init__(self):
+        from AppKit import NSPasteboard
+        super().__init__(NSPasteboard.generalPasteboard().changeCount)
+
+
+class EventWatcher(CounterWatcher):
+    # 统计外部工具输出的所有者变更事件（每行一次） / Counts owner-change events printed by a helper, one per line
+    def __init__(self, name, argv):
+        super().__init__(lambda: self._count)
+        self.name = name
+        self._count = 0
+        self._proc = subprocess.Popen(argv, stdout=subprocess.PIPE,
+                                      stderr=subprocess.DEVNULL)
+        threading.Thread(target=self._pump, daemon=True).start()
+
+    def _pump(self):
+        for _ in self._proc.stdout:
+            self._count += 1
+        # 辅助进程退出后退化为轮询 / Helper exited: degrade to polling
+        self._count = None
+
+    def close(self):
+        if self._proc.poll() is None:
+            self._proc.terminate()
+
+
+class FakeClipboard(CounterWatcher):
+    # 进程内假剪贴板，用于无界面测试检测延迟和空闲 CPU
+    # In-process fake clipboard for headless tests of detection latency and idle CPU
+    name = "fake"
+
+    def __init__(self, content=None):
+        super().__init__(lambda: self._seq)
+        self._lock = threading.Lock()
+        self._content = content
+        self._seq = 0
+        self.set_at = None
+        self.grabs = 0
+
+    def set(self, content):
+        with self._lock:
+            self._content = content
+            self._seq += 1
+            self.set_at = time.perf_counter()
+
+    def clear(self):
+        self.set(None)
+
+    def grab(self):
+        with self._lock:
+            self.grabs += 1
+            content = self._content
+        # 模拟真实剪贴板每次返回新解码的对象 / Mimic a real clipboard returning a freshly decoded object
+        return content.copy() if content is not None else None
+
+
+def make_watcher(name="auto"):
+    if name == "poll":
+        return ClipboardWatcher()
+    if name == "fake":
+        return FakeClipboard()
+    try:
+        if name in ("auto", "win32") and sys.platform == "win32":
+            return Win32Watcher()
+        if name in ("auto", "macos") and sys.platform == "darwin":
+            return MacWatcher()
+        if name in ("auto", "wayland") and os.environ.get("WAYLAND_DISPLAY") \
+                and shutil.which("wl-paste"):
+            return EventWatcher("wayland", ["wl-paste", "--watch", "echo"])
+        if name in ("auto", "x11") and shutil.which("clipnotify"):
+            return EventWatcher("x11", ["sh", "-c",
+                                        "while clipnotify -s clipboard; do echo; done"])
+    except Exception:
+        pass
+    return ClipboardWatcher()
+
+# ----------------------------------------------------------
+# 后台剪贴板监视线程 / Background clipboard monitor
+# 有变化后用最短间隔轮询，空闲时指数退避到最长间隔
+# Polls at the shortest interval right after activity, backs off exponentially when idle
+class ClipboardMonitor(threading.Thread):
+    def __init__(self, watcher, out_queue, min_interval=0.2, max_interval=2.0,
+                 paused=None, metrics=None, cache=None):
+        super().__init__(daemon=True)
+        self.watcher = watcher
+        self.out_queue = out_queue
+        self.paused = paused
+        self.metrics = metrics
+        self.cache = cache
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.last_grab_ms = 0.0
+        self.grab_count = 0
+        self.grab_total_ms = 0.0
+        self._digest = None
+        self._files = []
+        self._stop_evt = threading.Event()
+        self._wake = threading.Event()
+        self._poll_cond = threading.Condition()
+        self._polling = False
+        self.polls = 0
+        self.last_poll_grabbed = False
+
+    @property
+    def avg_grab_ms(self):
+        return self.grab_total_ms / self.grab_count if self.grab_count else 0.0
+
+    def run(self):
+        while not self._stop_evt.is_set():
+            with self._poll_cond:
+                self._polling = True
+            grabbed = False
+            try:
+                grabbed = self.poll_once() is not None
+            except Exception as e:
+                print("ClipboardMonitor:", e)
+            with self._poll_cond:
+                self._polling = False
+                self.polls += 1
+                self.last_poll_grabbed = grabbed
+                self._poll_cond.notify_all()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def poll_now(self, timeout=2.0):
+        # 请求立即轮询并等待一次在请求之后开始的轮询完成；返回它是否读取了剪贴板
+        # Requests an immediate poll and waits for one that started after the request;
+        # returns whether it read the clipboard
+        with self._poll_cond:
+            target = self.polls + (2 if self._polling else 1)
+            self.kick()
+            self._wake.set()
+            done = self._poll_cond.wait_for(lambda: self.polls >= target, timeout)
+            return done and self.last_poll_grabbed
+
+    def poll_once(self):
+        if self.cache is not None:
+            self.cache.sweep()
+        # 背压：保存队列满时暂不读取，变化留到恢复后再检测
+        # Backpressure: while the save queue is full, leave the change to be seen later
+        # 返回 None 表示本次没有读取剪贴板 / Returns None when the clipboard was not read
+        if self.paused and self.paused():
+            return None
+        if not self.watcher.changed():
+            self.backoff()
+            return None
+        timings = {}
+        t = time.perf_counter()
+        im = self.watcher.grab()
+        t = lap(timings, "grab", t)
+        # 文件管理器中复制的文件返回路径列表，在这里展开成图片文件，不占用 Tk 线程
+        # Files copied in a file manager come back as a list of paths; they are expanded into
+        # image files here, off the Tk thread
+        if isinstance(im, list):
+            digest = files_fingerprint(im)
+            if digest != self._digest:
+                self._files = expand_inputs(im)
+            im = self._files
+        else:
+            digest = image_fingerprint(im) if im is not None else None
+        if im is not None:
+            lap(timings, "fingerprint", t)
+        if self.metrics:
+            for stage, ms in timings.items():
+                self.metrics.observe(stage, ms)
+        self.last_grab_ms = timings["grab"]
+        self.grab_count += 1
+        self.grab_total_ms += self.last_grab_ms
+        active = digest != self._digest
+        self._digest = digest
+        if self.cache is not None:
+            if active:
+                self.cache.put(im if isinstance(im, Image.Image) else None, digest,
+                               self.watcher.last_seq)
+            else:
+                self.cache.confirm(digest, self.watcher.last_seq)
+        if active:
+            self.kick()
+        else:
+            self.backoff()
+        self.out_queue.put((im, digest, active, timings))
+        return active
+
+    def backoff(self):
+        self.interval = min(self.interval * 2, self.max_interval)
+
+    def kick(self):
+        self.interval = self.min_interval
+
+    def stop(self):
+        self._stop_evt.set()
+        self._wake.set()
+
+# ----------------------------------------------------------
+# 本地导入接口 / Local ingest endpoint
+# POST /save?fmt=JPG&long_edge=1280 ... 请求体为编码后的图片，或 JSON {"path": ..., 选项...}
+# POST /save?fmt=JPG&long_edge=1280 ... with encoded image bytes, or JSON {"path": ..., options...}
+SPOOL_BYTES = 8 << 20
+
+
+def load_server_token(path=TOKEN_FILE):
+    # 每次安装生成一次的随机令牌，客户端放在 X-Clipimg-Token 头中；文件只有本人可读
+    # Per-install random token that clients send in X-Clipimg-Token; the file is owner-only
+    try:
+        token = path.read_text(encoding="utf8").strip()
+        if token:
+            return token
+    except OSError:
+        pass
+    token = secrets.token_urlsafe(32)
+    atomic_write_bytes(path, token.encode("ascii"), mode=0o600)
+    return token
+
+
+def options_from_params(base, params, trusted=False):
+    # 参数与“格式/分辨率”面板一一对应；未带令牌的请求只能写到 base.directory 之内且不能覆盖
+    # Parameters mirror the Format/Resolution panel; requests without the token may only write
+    # inside base.directory and never overwrite
+    kw = {}
+    for key, value in params.items():
+        if key not in SaveOptions._fields or key in ("name_template", "fsync"):
+            raise ValueError("unknown option: {}".format(key))
+        default = SaveOptions._field_defaults.get(key, "")
+        value = str(value)
+        if isinstance(default, bool):
+            value = value.lower() in ("1", "true", "yes", "on")
+        elif isinstance(default, int):
+            value = int(value)
+        kw[key] = value
+    if "fmt" in kw:
+        kw["fmt"] = next((k for k in FORMATS if k.lower() == kw["fmt"].lower()), kw["fmt"])
+    opts = base._replace(**kw)
+    if opts.fmt not in FORMATS:
+        raise ValueError("unknown format: {}".format(opts.fmt))
+    if opts.resize_mode not in ("none", "long_edge", "wh"):
+        raise ValueError("unknown resize_mode: {}".format(opts.resize_mode))
+    if opts.resample not in RESIZE_SPEEDS:
+        raise ValueError("unknown resample: {}".format(opts.resample))
+    if not 1 <= opts.quality <= 100:
+        raise ValueError("quality must be 1-100")
+    if opts.name and (opts.name != pathlib.Path(opts.name).name or ".." in opts.name
+                      or "/" in opts.name or "\\" in opts.name):
+        raise ValueError("name must be a plain file name")
+    root = pathlib.Path(base.directory).resolve()
+    directory = (root / opts.directory).resolve()
+    if not trusted:
+        if directory != root and root not in directory.parents:
+            raise ValueError("directory must be inside {} without the token".format(root))
+        if opts.override:
+            raise ValueError("override needs the token")
+    return opts._replace(directory=str(directory))
+
+
+class IngestHandler(BaseHTTPRequestHandler):
+    server_version = "clipimg"
+
+    def do_POST(self):
+        timings = {}
+        t = time.perf_counter()
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != "/save":
+            return self.reply(404, error="not found")
+        # 浏览器发出的请求都带 Origin，一律拒绝，网页无法借用本接口写文件
+        # Browsers always send Origin; refusing it keeps web pages from writing files through us
+        if self.headers.get("Origin") is not None:
+            return self.reply(403, error="cross-origin requests are not accepted")
+        token = self.headers.get("X-Clipimg-Token", "").encode("utf8")
+        trusted = bool(self.server.token) and hmac.compare_digest(
+            token, self.server.token.encode("utf8"))
+        if self.server.require_token and not trusted:
+            return self.reply(401, error="missing or wrong X-Clipimg-Token")
+        params = dict(urllib.parse.parse_qsl(url.query))
+        try:
+            length = int(self.headers["Content-Length"])
+        except (TypeError, ValueError):
+            return self.reply(411, error="Content-Length required")
+        if length < 0:
+            return self.reply(400, error="negative Content-Length")
+        if length > self.server.max_bytes:
+            return self.reply(413, error="body larger than {} bytes".format(self.server.max_bytes))
+        try:
+            if self.headers.get_content_type() == "application/json":
+                body = json.loads(self.rfile.read(length))
+                if not isinstance(body, dict):
+                    raise ValueError("JSON body must be an object")
+                src = body.pop("path")
+                params.update(body)
+            else:
+                # 大请求体落到临时文件，不整块读入内存 / Large bodies spill to a temp file instead of memory
+                src = tempfile.SpooledTemporaryFile(SPOOL_BYTES)
+                left = length
+                while left:
+                    chunk = self.rfile.read(min(left, 1 << 20))
+                    if not chunk:
+                        raise ValueError("body ended early")
+                    src.write(chunk)
+                    left -= len(chunk)
+                src.seek(0)
+            t = lap(timings, "receive", t)
+            opts = options_from_params(self.server.base_options(), params, trusted)
+            im = Image.open(src)
+            im.load()
+            lap(timings, "decode", t)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            return self.reply(400, error=str(e))
+        fut = self.server.submit(im, opts, timings)
+        if fut is None:
+            return self.reply(503, error="save queue full")
+        try:
+            paths = fut.result(self.server.timeout)
+        except Exception as e:
+            return self.reply(500, error=str(e))
+        if not paths:
+            return self.reply(409, error="not saved, see log")
+        self.reply(200, paths=[str(p) for p in paths],
+                   ms={k: round(v, 3) for k, v in timings.items()})
+
+    def reply(self, status, **body):
+        data = json.dumps(body).encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+class IngestServer(ThreadingHTTPServer):
+    # 仅监听回环地址；每个连接一个线程，保存仍走同一个有界保存队列
+    # Loopback only; one thread per connection, saves still go through the one bounded save queue
+    daemon_threads = True
+
+    def __init__(self, port, submit, base_options, max_bytes=64 << 20, timeout=120.0,
+                 token=None, require_token=True):
+        super().__init__(("127.0.0.1", port), IngestHandler)
+        self.token = token
+        self.require_token = require_token
+        self.submit = submit
+        self.base_options = base_options
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+# ----------------------------------------------------------
+class App(tk.Tk if tk else object):
     def __init__(self):
         super().__init__()
-        self.cfg = load_config()
+        self.cfg = ConfigStore()
         self.L = LANG[self.cfg["lang"]]
         self.title(self.L["app"])
         self.resizable(False, False)
@@ -170,19 +2013,69 @@ class App(tk.Tk):
         self.long_edge = tk.IntVar(value=1920)
         self.width = tk.IntVar(value=1920)
         self.height = tk.IntVar(value=1080)
+        self.resample = tk.StringVar(value=self.cfg["resample"])
         self.quality = tk.IntVar(value=self.cfg["quality"])
+        self.max_kb = tk.IntVar(value=self.cfg["max_kb"])
         self.copy_path = tk.BooleanVar(value=self.cfg["copy_path"])
         self.override = tk.BooleanVar(value=self.cfg["override"])
         self.listen_mode = tk.BooleanVar(value=self.cfg["listen_mode"])
+        self.use_profile = tk.BooleanVar(value=self.cfg["use_profile"])
+        self.profile = load_profile(self.cfg["export_profile"])
 
-        self._last_digest = None
         self.log_queue = queue.Queue()
+        self.log_limit = max(1, self.cfg["log_lines"])
+        self.file_log = self.file_log_listener = None
+        if self.cfg["log_file"]:
+            try:
+                self.file_log, self.file_log_listener = init_file_log(
+                    self.cfg["log_file"], self.cfg["log_max_kb"], self.cfg["log_backups"])
+            except OSError as e:
+                print("init_file_log:", e)
+        self.saved_index = SavedIndex()
+        self.sink = FILES
+        if self.cfg["sink"] == "archive":
+            self.sink = ArchiveSink(self.cfg["archive_file"]
+                                    or ArchiveSink.session_path(self.cfg["last_dir"]),
+                                    self.cfg["fsync"])
+        self.near_dup = None
+        budget = self.cfg["memory_budget_mb"] << 20
+        self.mem_budget = MemoryBudget(budget) if budget else None
+        # 有预算时缓存最多占一半 / With a budget the cache may use at most half of it
+        cache_max = self.cfg["cache_max_mb"] << 20
+        self.capture_cache = CaptureCache(min(cache_max, budget // 2) if budget else cache_max,
+                                          self.cfg["cache_ttl_s"])
+        self.metrics = StageMetrics(path=self.cfg["metrics_file"] or None)
+        self._saves = 0
+        self.clip_queue = queue.Queue()
+        self.ingest_pool = ThreadPoolExecutor(max_workers=max(1, self.cfg["ingest_workers"]),
+                                              thread_name_prefix="ingest")
+        self.executor = SaveExecutor(self.cfg["save_workers"], self.cfg["save_queue"],
+                                     self.cfg["save_policy"], self.on_executor_change)
+        self.watcher = make_watcher(self.cfg["clipboard_backend"])
+        self.monitor = ClipboardMonitor(
+            self.watcher, self.clip_queue,
+            self.cfg["poll_min_ms"] / 1000, self.cfg["poll_max_ms"] / 1000,
+            paused=lambda: self.executor.policy == "block" and self.executor.full(),
+            metrics=self.metrics, cache=self.capture_cache)
 
         self.init_ui()
         self.init_tray()
         self.init_hotkey()
+        self.init_near_dup()
+        self.log("log_watcher", self.watcher.name)
+        if self.sink is not FILES:
+            self.log("log_archive", self.sink.path)
         self.after(200, self.process_log)
-        self.schedule_clipboard()
+        self.monitor.start()
+        self.after(100, self.process_clipboard)
+        self.recompressor = None
+        if self.cfg["recompress"]:
+            self.recompressor = Recompressor(self.executor.busy, self.cfg["recompress_idle_s"],
+                                             self.on_recompressed, self.cfg["fsync"])
+            self.recompressor.start()
+        self.server = None
+        if self.cfg["server_port"]:
+            self.init_server()
 
     # ---------------- UI ----------------
     def init_ui(self):
@@ -228,6 +2121,15 @@ class App(tk.Tk):
         self.quality_scl.pack(side="left")
         self.quality_val = ttk.Label(self.fmt_frm, text=str(self.quality.get()))
         self.quality_val.pack(side="left", padx=5)
+        self.max_kb_lbl = ttk.Label(self.fmt_frm, text=self.L["max_kb"])
+        self.max_kb_lbl.pack(side="left", padx=(10, 2))
+        self.max_kb_spn = ttk.Spinbox(self.fmt_frm, from_=0, to=100000, increment=50,
+                                      textvariable=self.max_kb, width=6)
+        self.max_kb_spn.pack(side="left")
+        self.profile_btn = ttk.Checkbutton(self.fmt_frm, text=self.L["use_profile"],
+                                           variable=self.use_profile,
+                                           command=self.on_profile_toggle)
+        self.profile_btn.pack(side="left", padx=5)
         self.quality_scl.bind("<Motion>",
                               lambda e: self.quality_val.config(text=str(int(self.quality.get()))))
         self.on_fmt_change()
@@ -285,6 +2187,20 @@ class App(tk.Tk):
             ttk.Label(self.res_frm, text=L["height"]).grid(row=1, column=2, sticky="e")
             ttk.Spinbox(self.res_frm, from_=1, to=9999,
                         textvariable=self.height, width=6).grid(row=1, column=3, sticky="w")
+        if mode != "none":
+            ttk.Label(self.res_frm, text=L["resample"]).grid(row=2, column=0, sticky="e")
+            speeds = list(RESIZE_SPEEDS)
+            combo = ttk.Combobox(self.res_frm, values=L["resample_options"],
+                                 state="readonly", width=10)
+            combo.current(speeds.index(self.resample.get())
+                          if self.resample.get() in speeds else speeds.index("fast"))
+            combo.grid(row=2, column=1, columnspan=2, sticky="w")
+            combo.bind("<<ComboboxSelected>>",
+                       lambda e: self.on_resample_change(speeds[combo.current()]))
+
+    def on_resample_change(self, speed):
+        self.resample.set(speed)
+        self.cfg.update(resample=speed)
 
     def on_fmt_change(self, *args):
         lossy = not FORMATS[self.fmt_name.get()][1]
@@ -292,6 +2208,14 @@ class App(tk.Tk):
         self.quality_lbl.config(state=st)
         self.quality_scl.config(state=st)
         self.quality_val.config(state=st)
+        st = "normal" if FORMATS[self.fmt_name.get()][0] in SIZE_LIMIT_EXTS else "disabled"
+        self.max_kb_lbl.config(state=st)
+        self.max_kb_spn.config(state=st)
+
+    def on_profile_toggle(self):
+        self.cfg.update(use_profile=self.use_profile.get())
+        if self.use_profile.get():
+            self.log("log_profile", describe_profile(self.profile))
 
     def choose_dir(self):
         d = filedialog.askdirectory(initialdir=self.save_dir.get())
@@ -301,24 +2225,33 @@ class App(tk.Tk):
     # ---------------- 日志 / Log ----------------
     def log(self, msg_key, *args):
         message = self.L[msg_key].format(*args) if args else self.L[msg_key]
-        self.log_queue.put(message)
+        self.log_queue.put(f"{datetime.now():%H:%M:%S}  {message}\n")
+        if self.file_log:
+            self.file_log.info(message)
 
     def process_log(self):
+        # 每次只插入一次，并把控件裁剪到 log_lines 行
+        # One insert per tick; the widget is trimmed to log_lines lines
+        batch = []
         try:
             while True:
-                msg = self.log_queue.get_nowait()
-                self.log_text.config(state="normal")
-                self.log_text.insert("end", f"{datetime.now():%H:%M:%S}  {msg}\n")
-                self.log_text.see("end")
-                self.log_text.config(state="disabled")
+                batch.append(self.log_queue.get_nowait())
         except queue.Empty:
             pass
+        if batch:
+            limit = self.log_limit
+            self.log_text.config(state="normal")
+            self.log_text.insert("end", "".join(batch[-limit:]))
+            excess = int(self.log_text.index("end-1c").split(".")[0]) - 1 - limit
+            if excess > 0:
+                self.log_text.delete("1.0", f"{excess + 1}.0")
+            self.log_text.see("end")
+            self.log_text.config(state="disabled")
         self.after(200, self.process_log)
 
     # ---------------- 语言 / 托盘 / Language / Tray ----------------
     def switch_lang(self, lang):
-        self.cfg["lang"] = lang
-        save_config(self.cfg)
+        self.cfg.update(lang=lang)
         self.L = LANG[lang]
         self.refresh_text()
     
@@ -329,6 +2262,7 @@ class App(tk.Tk):
         self.status_lbl.config(text=L["check"])
         self.blank_lbl.config(text=L["blank_ts"])
         self.quality_lbl.config(text=L["quality"])
+        self.max_kb_lbl.config(text=L["max_kb"])
         self.btn_save.config(text=L["save_btn"])
         
         # Update frame titles
@@ -340,6 +2274,7 @@ class App(tk.Tk):
         self.override_btn.config(text=L["override"])
         self.copy_path_btn.config(text=L["copy_path"])
         self.listen_btn.config(text=L["listen_mode"])
+        self.profile_btn.config(text=L["use_profile"])
         
         # Rebuild resolution UI
         self.build_resize_ui()
@@ -381,6 +2316,18 @@ class App(tk.Tk):
         if hasattr(self, 'tray_icon'):
             self.tray_icon.menu = self.build_tray_menu()
 
+    def on_executor_change(self, event, st):
+        # 可能在工作线程中调用，只做线程安全的操作 / May run on worker threads: thread-safe calls only
+        if event == "drop_oldest":
+            self.log("log_queue_drop", st["depth"], st["in_flight"], st["dropped"])
+        elif event == "coalesce":
+            self.log("log_queue_coalesce", st["depth"], st["in_flight"], st["coalesced"])
+        if hasattr(self, 'tray_icon'):
+            busy = st["depth"] or st["in_flight"]
+            self.tray_icon.title = "{} – {}".format(
+                self.L["app"], self.L["tray_queue"].format(
+                    st["depth"], st["in_flight"], st["dropped"])) if busy else self.L["app"]
+
     def show_window(self, *args):
         self.after(0, lambda: (self.deiconify(), self.lift()))
 
@@ -393,6 +2340,19 @@ class App(tk.Tk):
     def quit_app(self, *args):
         if hasattr(self, 'tray_icon'):
             self.tray_icon.stop()
+        self.monitor.stop()
+        self.watcher.close()
+        if self.recompressor:
+            self.recompressor.stop()
+        if self.server:
+            self.server.stop()
+        self.executor.shutdown()
+        self.ingest_pool.shutdown(wait=False, cancel_futures=True)
+        self.sink.close()
+        self.metrics.close()
+        self.cfg.flush()
+        if self.file_log_listener:
+            self.file_log_listener.stop()
         self.destroy()
 
     def toggle_listen_tray(self):
@@ -407,99 +2367,554 @@ class App(tk.Tk):
             self.log("log_hotkey_required")
             return
         def hotkey():
-            if not self.btn_save.instate(["disabled"]):
-                self.save_image()
+            # pynput 线程中只做转交，Tk 操作回到主线程 / Hand off from the pynput thread; Tk work runs on the Tk thread
+            self.after(0, self.on_hotkey)
         listener = keyboard.GlobalHotKeys({'<ctrl>+<shift>+s': hotkey})
         listener.start()
         self.log("log_hotkey")
     
 
+    def init_near_dup(self):
+        method = self.cfg["near_dup"]
+        if method not in PerceptualFilter.HASHES:
+            return
+        if np is None:
+            self.log("log_numpy_required")
+            return
+        self.near_dup = PerceptualFilter(method, self.cfg["near_dup_threshold"])
+
+    def init_server(self):
+        try:
+            self.server = IngestServer(self.cfg["server_port"], self.submit_remote,
+                                       self.server_options,
+                                       self.cfg["server_max_mb"] << 20,
+                                       token=load_server_token(),
+                                       require_token=self.cfg["server_require_token"]).start()
+            self.log("log_server", self.server.server_address[1], TOKEN_FILE)
+        except OSError as e:
+            self.log("log_server_fail", e)
+
+    def server_options(self):
+        # 在请求线程中调用，不能读取 Tk 变量，改用配置 / Called on request threads, so it reads the config, not Tk variables
+        return SaveOptions(directory=self.cfg["last_dir"], quality=self.cfg["quality"],
+                           max_kb=self.cfg["max_kb"],
+                           override=self.cfg["override"], resample=self.cfg["resample"],
+                           name_template=self.cfg["name_template"], fsync=self.cfg["fsync"])
+
+    def submit_remote(self, im, opts, timings):
+        if self.executor.full():
+            return None
+        t = time.perf_counter()
+        digest = image_fingerprint(im)
+        lap(timings, "fingerprint", t)
+        return self.executor.submit(self._save, im, opts, False, digest, False, None, timings,
+                                    True, True, force=True)
+
+    def on_hotkey(self):
+        if not self.btn_save.instate(["disabled"]):
+            self.save_image()
+
     # ---------------- 监听 / Listen ----------------
     def on_listen_toggle(self):
-        save_config({**self.cfg, "listen_mode": self.listen_mode.get()})
+        self.cfg.update(listen_mode=self.listen_mode.get())
+        self.monitor.kick()
         self.update_tray_menu()
         self.log("log_listen_on" if self.listen_mode.get() else "log_listen_off")
 
-    def schedule_clipboard(self):
-        self.check_clipboard()
-        self.after(500 if self.listen_mode.get() else 1000, self.schedule_clipboard)
+    def process_clipboard(self):
+        # 和 process_log 一样在 Tk 线程中消费后台结果 / Drains monitor results on the Tk thread, like process_log
+        try:
+            while True:
+                self.check_clipboard(*self.clip_queue.get_nowait())
+        except queue.Empty:
+            pass
+        self.after(100, self.process_clipboard)
 
-    def check_clipboard(self):
-        im = get_clipboard_image()
-        if im is None:
+    def check_clipboard(self, im, digest, active=True, timings=None):
+        if active:
+            self.log("log_grab", self.monitor.last_grab_ms, self.monitor.interval * 1000)
+        files = im if isinstance(im, list) else None
+        if im is None or files == []:
             self.status_lbl.config(text=self.L["none"], foreground="red")
             self.btn_save.state(["disabled"])
-            self._last_digest = None
             return
-        digest = im.tobytes()[:1024]
-        if self.listen_mode.get() and digest != self._last_digest:
-            self._last_digest = digest
-            threading.Thread(target=self.auto_save_image, args=(im,), daemon=True).start()
+        # 仅在内容确实变化时自动保存 / Auto-save only when the content actually changed
+        if self.listen_mode.get() and active:
+            saved = self.saved_index.lookup(digest) if self.cfg["dedup"] else None
+            if saved:
+                self.log("log_dup", saved)
+            elif files:
+                self.executor.submit(self._ingest, files, self.current_options(), False, digest,
+                                     self.copy_path.get(), key=digest)
+            else:
+                self.auto_save_image(im, digest, timings)
+        if files:
+            self.status_lbl.config(text=self.L["files"].format(len(files)), foreground="green")
         else:
-            self._last_digest = None
-        self.status_lbl.config(text=self.L["ok"], foreground="green")
+            self.status_lbl.config(text=self.L["ok"], foreground="green")
         self.btn_save.state(["!disabled"])
 
     # ---------------- 保存 / Save ----------------
-    def make_path(self):
-        d = pathlib.Path(self.save_dir.get())
-        d.mkdir(parents=True, exist_ok=True)
-        name = self.file_name.get().strip() or datetime.now().strftime("%Y%m%d_%H%M%S")
-        ext = FORMATS[self.fmt_name.get()][0]
-        path = d / f"{name}.{ext}"
-        if not self.override.get():
-            counter = 1
-            while path.exists():
-                path = d / f"{name}_{int(time.time()*1000)}.{ext}"
-                counter += 1
-        return path
+    def current_options(self):
+        # 只能在 Tk 线程调用：把界面状态固化为不可变的选项 / Tk thread only: snapshots UI state into immutable options
+        return SaveOptions(directory=self.save_dir.get(),
+                           name=self.file_name.get().strip(),
+                           fmt=self.fmt_name.get(),
+                           resize_mode=self.resize_mode.get(),
+                           long_edge=self.long_edge.get(),
+                           width=self.width.get(),
+                           height=self.height.get(),
+                           quality=int(self.quality.get()),
+                           max_kb=self.current_max_kb(),
+                           override=self.override.get(),
+                           resample=self.resample.get(),
+                           name_template=self.cfg["name_template"],
+                           fsync=self.cfg["fsync"])
+
+    def current_max_kb(self):
+        try:
+            return max(0, int(self.max_kb.get()))
+        except (tk.TclError, ValueError):
+            return 0
 
     def save_image(self):
-        im = get_clipboard_image()
-        if im is None:
-            messagebox.showerror(self.L["error"], self.L["err_no_img"])
+        # 缓存的截图仍是当前剪贴板内容时直接使用，省去重新读取和解码；
+        # 序号对不上就重新抓取，没有序号的后端先让监视线程立即轮询一次
+        # Use the monitor's cached capture when it still matches the clipboard, skipping a re-grab
+        # and decode. A sequence mismatch grabs fresh; backends without a sequence first have the
+        # monitor poll once right away
+        im, digest, seq = self.capture_cache.get()
+        args = (self.current_options(), True, digest, self.copy_path.get(), self.current_profile())
+        if self.watcher.counter is None:
+            self.executor.submit(self._poll_and_save, *args, force=True)
+        elif im is not None and seq is not None and self.watcher.counter() == seq:
+            self.executor.submit(self._save, im, *args, force=True)
+        else:
+            self.executor.submit(self._grab_and_save, *args, force=True)
+
+    def _poll_and_save(self, opts, show_msg, digest, copy_path, profile):
+        if self.monitor.poll_now():
+            im, digest, _ = self.capture_cache.get()
+            if im is not None:
+                return self._save(im, opts, show_msg, digest, copy_path, profile)
+        return self._grab_and_save(opts, show_msg, digest, copy_path, profile)
+
+    def _grab_and_save(self, opts, show_msg, digest, copy_path, profile):
+        timings = {}
+        t = time.perf_counter()
+        im = self.watcher.grab()
+        t = lap(timings, "grab", t)
+        files = expand_inputs(im) if isinstance(im, list) else None
+        if files:
+            self._ingest(files, opts, show_msg, files_fingerprint(im), copy_path)
             return
-        self._save(im, self.make_path(), show_msg=True)
+        if not isinstance(im, Image.Image):
+            self.after(0, lambda: messagebox.showerror(self.L["error"], self.L["err_no_img"]))
+            return
+        digest = image_fingerprint(im)
+        lap(timings, "fingerprint", t)
+        self._save(im, opts, show_msg, digest, copy_path, profile, timings, True)
+
+    def auto_save_image(self, im, digest=None, timings=None):
+        self.executor.submit(self._save, im, self.current_options(), False, digest,
+                             self.copy_path.get(), self.current_profile(), timings, key=digest)
 
-    def auto_save_image(self, im):
-        self._save(im, self.make_path(), show_msg=False)
+    def current_profile(self):
+        return self.profile if self.use_profile.get() and self.profile else None
 
-    def _save(self, im, path, show_msg=False):
+    def _save(self, im, opts, show_msg=False, digest=None, copy_path=False, profile=None,
+              capture_timings=None, owned=False, remote=False):
+        # owned=True 只用于本次保存自己解码、别处不会再用的图片（重新抓取、接口请求），可及早释放；
+        # 监视线程的截图可能同时被缓存和另一次保存使用，不能释放
+        # owned=True only for images this save decoded itself and nobody else holds (fresh grabs,
+        # endpoint requests), which may be freed early; monitor captures can be shared by the
+        # cache and another queued save.
+        # remote=True 为接口请求：客户端明确要求保存，不经过近似去重，也不改动界面的配置
+        # remote=True for endpoint requests: the client asked for this save explicitly, so it
+        # bypasses the near-duplicate filter and leaves the GUI's settings untouched
+        if self.recompressor:
+            self.recompressor.touch()
+        timings = {}
+        phash_h = None
+        # 监听模式下跳过近似重复的截图 / Listen mode skips near-duplicate captures
+        if not show_msg and not remote and self.near_dup is not None:
+            t = time.perf_counter()
+            phash_h, dist = self.near_dup.nearest(im)
+            lap(timings, "phash", t)
+            if dist is not None:
+                self.log("log_near_dup", dist, self.near_dup.skipped)
+                return
+        need = estimate_save_bytes(im, opts, profile)
+        if self.mem_budget is not None and not self.mem_budget.acquire(need, timeout=60):
+            self.log("log_mem_refuse", need / 1e6, self.cfg["memory_budget_mb"])
+            if phash_h is not None:
+                self.near_dup.discard(phash_h)
+            return
+        mem = MemoryTracker(image_nbytes(im))
         try:
-            mode = self.resize_mode.get()
-            if mode == "long_edge":
-                im.thumbnail((self.long_edge.get(), self.long_edge.get()), Image.LANCZOS)
-            elif mode == "wh":
-                im = im.resize((self.width.get(), self.height.get()), Image.LANCZOS)
-            ext = path.suffix.lower()[1:]
-            kw = {}
-            if ext in ("jpg", "jpeg"):
-                im = im.convert("RGB")
-                kw["quality"] = self.quality.get()
-            elif ext == "webp":
-                kw["quality"] = self.quality.get()
-            im.save(path, **kw)
+            if profile:
+                paths = export_targets(im, opts, profile, timings, mem, owned, self.sink, digest)
+            else:
+                paths = [save_image_file(im, None, opts, timings, mem, owned, self.sink, digest)]
+            path = paths[0]
+        except ExportError as e:
+            # 部分目标已写出：报告错误，已写出的照常记录和建索引
+            # Some targets were written: report the error, then log and index those as usual
+            self.log("err_save", str(e))
+            if show_msg:
+                msg = self.L["err_save"].format(e)
+                self.after(0, lambda: messagebox.showerror(self.L["error"], msg))
+            paths = e.paths
+            path = paths[0]
         except Exception as e:
             self.log("err_save", str(e))
+            if phash_h is not None:
+                self.near_dup.discard(phash_h)
             if show_msg:
-                messagebox.showerror(self.L["error"], self.L["err_save"].format(e))
+                msg = self.L["err_save"].format(e)
+                self.after(0, lambda: messagebox.showerror(self.L["error"], msg))
             return
+        finally:
+            if self.mem_budget is not None:
+                self.mem_budget.release(need)
+        if phash_h is not None:
+            self.near_dup.add(phash_h)
+
+        if not remote:
+            t = time.perf_counter()
+            # 归档引用不是目录里的文件，不改动保存目录 / An archive ref is not a file in a folder; keep last_dir
+            dirs = {"last_dir": str(path.parent)} if self.sink is FILES else {}
+            self.cfg.update(quality=opts.quality, max_kb=opts.max_kb, copy_path=copy_path,
+                            override=opts.override, **dirs)
+            lap(timings, "config", t)
         
-        save_config({**self.cfg,
-                    "last_dir": str(path.parent),
-                    "quality": self.quality.get(),
-                    "copy_path": self.copy_path.get(),
-                    "override": self.override.get()})
-        
+        if digest:
+            self.saved_index.add(digest, path)
+
         msg_key = "saved" if show_msg else "auto_saved"
-        self.log(msg_key, str(path))
+        self.log(msg_key, "\n".join(str(p) for p in paths))
         
-        if self.copy_path.get():
+        if copy_path:
+            t = time.perf_counter()
             pyperclip.copy(str(path))
+            lap(timings, "copy_path", t)
+
+        if self.recompressor and self.sink is FILES:
+            for p in paths:
+                self.recompressor.add(p)
+        if self.mem_budget is not None:
+            self.log("log_mem_peak", mem.peak / 1e6, self.cfg["memory_budget_mb"])
+        self.record_metrics(timings, capture_timings, path, opts, mem.peak)
+        # 保存阶段计时并入调用方的计时，接口回复才能带上 / Merge the save stages into the
+        # caller's timings so the endpoint reply can report them
+        if capture_timings is not None:
+            capture_timings.update(timings)
+        return paths
+
+    def _ingest(self, files, opts, show_msg=False, digest=None, copy_path=False):
+        # 在保存线程中运行，逐个文件分发到有界的导入线程池
+        # Runs on a save worker and fans the files out to the bounded ingest pool
+        plan = plan_outputs(files, opts)
+        self.log("log_ingest_start", len(plan), max(1, self.cfg["ingest_workers"]))
+        step = max(1, len(plan) // 10)
+        paths = []
+
+        def on_result(n, src, dst, err):
+            if err is not None:
+                self.log("log_ingest_fail", src, err)
+                return
+            paths.append(dst)
+            if n % step == 0 or n == len(plan):
+                self.log("log_ingest_progress", n, len(plan), dst)
+
+        stats = convert_files(plan, opts, self.ingest_pool, on_result)
+        self.log("log_ingest_done", stats["images"], stats["copied"], stats["failed"],
+                 stats["seconds"], stats["images_per_s"], stats["in_mb_per_s"])
+        if not paths:
+            if show_msg:
+                self.after(0, lambda: messagebox.showerror(self.L["error"], self.L["err_no_img"]))
+            return
+        self.cfg.update(last_dir=str(pathlib.Path(paths[0]).parent), quality=opts.quality,
+                        copy_path=copy_path, override=opts.override)
+        if digest:
+            self.saved_index.add(digest, paths[0])
+        if copy_path:
+            pyperclip.copy("\n".join(paths))
+
+    def on_recompressed(self, path, before, after):
+        self.log("log_recompress", pathlib.Path(path).name, before / 1024, after / 1024,
+                 self.recompressor.saved_bytes / 1e6)
+
+    def record_metrics(self, timings, capture_timings, path, opts, peak_bytes=0):
+        # 抓取/指纹已由监视线程计入滚动统计，这里只写入完整记录
+        # grab/fingerprint were observed by the monitor already; they only go into the full record
+        for stage, ms in timings.items():
+            self.metrics.observe(stage, ms)
+        stages = {**(capture_timings or {}), **timings}
+        self.metrics.emit({"path": str(path), "format": opts.fmt,
+                           "stages": {k: round(v, 3) for k, v in stages.items()},
+                           "total_ms": round(sum(stages.values()), 3),
+                           "peak_mb": round(peak_bytes / 1e6, 1)})
+        self._saves += 1
+        every = self.cfg["metrics_every"]
+        if every and self._saves % every == 0:
+            self.log("log_metrics", self.metrics.format_summary())
+
+
+# ----------------------------------------------------------
+# 命令行 / Command line
+def _format_name(value):
+    for k in FORMATS:
+        if k.lower() == value.lower():
+            return k
+    raise argparse.ArgumentTypeError("unknown format: {}".format(value))
+
+
+def _size(value):
+    try:
+        w, h = (int(x) for x in value.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected WIDTHxHEIGHT, got {}".format(value))
+    return w, h
+
+
+def options_from_args(args):
+    mode, w, h = "none", 1920, 1080
+    if args.size:
+        mode, (w, h) = "wh", args.size
+    elif args.long_edge:
+        mode = "long_edge"
+    return SaveOptions(directory=args.output, name=getattr(args, "name", "") or "",
+                       fmt=args.format, resize_mode=mode,
+                       long_edge=args.long_edge or 1920, width=w, height=h,
+                       quality=args.quality, override=args.overwrite,
+                       resample=args.resample,
+                       name_template=getattr(args, "name_template",
+                                             SaveOptions._field_defaults["name_template"]),
+                       fsync=args.fsync, max_kb=args.max_kb)
+
+
+def expand_inputs(patterns, recursive=False):
+    exts = {ext for ext, fmt in Image.registered_extensions().items() if fmt in Image.OPEN}
+    found, seen = [], set()
+    for pattern in patterns:
+        p = pathlib.Path(pattern)
+        if p.is_dir():
+            cands = p.rglob("*") if recursive else p.iterdir()
+        elif p.is_file():
+            cands = [p]
+        else:
+            cands = (pathlib.Path(x) for x in sorted(glob.glob(pattern, recursive=True)))
+        for c in cands:
+            if c.is_file() and c.suffix.lower() in exts and c not in seen:
+                seen.add(c)
+                found.append(c)
+    return found
+
+
+def plan_outputs(sources, opts):
+    # 在父进程中一次性分配输出名，避免并行进程争用同名文件
+    # Assign every output name up front in the parent so parallel workers never race for a name
+    ext = FORMATS[opts.fmt][0]
+    return [(src, NAMES.allocate(opts.directory, src.stem, ext, opts.override))
+            for src in sources]
+
+
+def files_fingerprint(paths):
+    # 复制的文件列表按路径、大小和修改时间识别，不读取内容
+    # A copied file list is identified by path, size and mtime without reading the files
+    h = hashlib.sha1()
+    for p in paths:
+        try:
+            st = os.stat(p)
+            h.update("{}|{}|{}\n".format(p, st.st_size, st.st_mtime_ns).encode("utf8"))
+        except OSError:
+            h.update("{}\n".format(p).encode("utf8"))
+    return h.hexdigest()
+
+
+def needs_transcode(src, opts):
+    # Image.open 只读文件头：格式相同且尺寸不变的文件无需解码
+    # Image.open only reads the header: same format and unchanged size needs no decode
+    if size_limited(opts) and os.path.getsize(src) > opts.max_kb * 1024:
+        return True
+    with Image.open(src) as im:
+        return im.format != pil_format(opts.fmt) or target_size(im.size, opts) != im.size
+
+
+def copy_file(src, dst, opts):
+    with open(src, "rb") as f:
+        return write_file(dst, lambda out: shutil.copyfileobj(f, out, 1 << 20), opts)
+
+
+def convert_file(src, dst, opts):
+    copied = not needs_transcode(src, opts)
+    if copied:
+        dst = copy_file(src, dst, opts)
+    else:
+        with Image.open(src) as im:
+            dst = save_image_file(im, dst, opts)
+    return str(src), str(dst), os.path.getsize(src), os.path.getsize(dst), copied
+
+
+def convert_files(plan, opts, pool, on_result=None):
+    # 在给定的进程池/线程池中并行转换，on_result(n, src, dst, err) 在完成时逐个回调
+    # Converts in parallel on the given process/thread pool; on_result(n, src, dst, err) fires per file
+    done = failed = copied = in_bytes = out_bytes = 0
+    t0 = time.perf_counter()
+    futs = {pool.submit(convert_file, src, dst, opts): src for src, dst in plan}
+    for fut in as_completed(futs):
+        try:
+            src, dst, nin, nout, raw = fut.result()
+        except Exception as e:
+            failed += 1
+            if on_result:
+                on_result(done + failed, str(futs[fut]), None, e)
+            continue
+        done += 1
+        copied += raw
+        in_bytes += nin
+        out_bytes += nout
+        if on_result:
+            on_result(done + failed, src, dst, None)
+    elapsed = max(time.perf_counter() - t0, 1e-9)
+    return {"images": done, "failed": failed, "copied": copied, "seconds": elapsed,
+            "images_per_s": done / elapsed,
+            "in_mb_per_s": in_bytes / elapsed / 1e6,
+            "out_mb_per_s": out_bytes / elapsed / 1e6}
+
+
+def run_batch(sources, opts, jobs=None, out=sys.stdout):
+    plan = plan_outputs(sources, opts)
+
+    def on_result(n, src, dst, err):
+        if err is not None:
+            print("FAILED {}: {}".format(src, err), file=out)
+        else:
+            print("[{}/{}] {} -> {}".format(n, len(plan), src, dst), file=out)
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        stats = convert_files(plan, opts, pool, on_result)
+    print("{images} images ({copied} copied as-is, {failed} failed) in {seconds:.2f} s: "
+          "{images_per_s:.1f} images/s, {in_mb_per_s:.1f} MB/s in, "
+          "{out_mb_per_s:.1f} MB/s out".format(**stats), file=out)
+    return stats
+
+
+def build_parser(cfg):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("-o", "--output", default=cfg["last_dir"], help="output directory")
+    common.add_argument("-f", "--format", type=_format_name, default="PNG",
+                        help="one of: " + ", ".join(FORMATS))
+    common.add_argument("-q", "--quality", type=int, default=cfg["quality"],
+                        help="JPG/WebP quality 1-100")
+    common.add_argument("--max-kb", type=int, default=0,
+                        help="JPG/WebP: highest quality up to -q that fits in N KB, downscaling if needed")
+    grp = common.add_mutually_exclusive_group()
+    grp.add_argument("--long-edge", type=int, help="shrink so the long edge is at most N px")
+    grp.add_argument("--size", type=_size, help="resize to exactly WIDTHxHEIGHT")
+    common.add_argument("--resample", choices=list(RESIZE_SPEEDS), default=cfg["resample"],
+                        help="resize speed/quality trade-off")
+    common.add_argument("--overwrite", action="store_true", help="allow overwriting files")
+    common.add_argument("--fsync", action="store_true", default=cfg["fsync"],
+                        help="fsync each file before renaming it into place")
+
+    parser = argparse.ArgumentParser(prog="clipimg",
+                                     description="Clipboard Image Saver (no arguments starts the GUI)")
+    sub = parser.add_subparsers(dest="command")
+    p = sub.add_parser("save", parents=[common], help="save the clipboard image once")
+    p.add_argument("-n", "--name", default="", help="file name without extension (default: template)")
+    p.add_argument("--name-template", default=cfg["name_template"],
+                   help="fields: {date} {time} {ms} {seq} {fmt} {w} {h}")
+    p.add_argument("--profile", action="store_true",
+                   help="write every target of export_profile from the config file")
+    p = sub.add_parser("batch", parents=[common], help="convert/resize image files in parallel")
+    p.add_argument("inputs", nargs="+", help="files, directories or glob patterns")
+    p.add_argument("-r", "--recursive", action="store_true", help="descend into directories")
+    p.add_argument("-j", "--jobs", type=int, default=None, help="worker processes (default: CPU count)")
+    p = sub.add_parser("export", help="list or extract images from an archive (sink: archive)")
+    p.add_argument("archive", help="archive .sqlite file")
+    p.add_argument("-o", "--output", default=".", help="output directory")
+    p.add_argument("--id", type=int, action="append", dest="ids", help="only this entry (repeatable)")
+    p.add_argument("--since", type=datetime.fromisoformat,
+                   help="only entries saved at or after this ISO time")
+    p.add_argument("--fingerprint", help="only entries with this fingerprint")
+    p.add_argument("--list", action="store_true", help="print the index instead of extracting")
+    p.add_argument("--overwrite", action="store_true", help="allow overwriting files")
+    return parser
+
+
+def export_archive(args, out=sys.stdout):
+    if not pathlib.Path(args.archive).is_file():
+        print("no such archive: {}".format(args.archive), file=sys.stderr)
+        return 1
+    archive = ArchiveSink(args.archive)
+    try:
+        since = args.since.timestamp() if args.since else None
+        if args.list:
+            for rowid, ts, name, fmt, w, h, fp, n in archive.entries(args.ids, since,
+                                                                    args.fingerprint):
+                print("{}\t{:%Y-%m-%d %H:%M:%S}\t{}\t{}\t{}x{}\t{}\t{}".format(
+                    rowid, datetime.fromtimestamp(ts), name, fmt, w, h, n, fp or ""), file=out)
+            return 0
+        for path in archive.export(args.output, args.ids, since, args.fingerprint,
+                                   args.overwrite):
+            print(path, file=out)
+        return 0
+    finally:
+        archive.close()
+
+
+def cli_main(argv=None):
+    cfg = load_config()
+    parser = build_parser(cfg)
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 2
+    if args.command == "export":
+        return export_archive(args)
+    opts = options_from_args(args)
+    if args.command == "save":
+        im = get_clipboard_image()
+        if isinstance(im, list) and expand_inputs(im):
+            stats = run_batch(expand_inputs(im), opts)
+            return 1 if stats["failed"] else 0
+        if not isinstance(im, Image.Image):
+            print(LANG["en"]["err_no_img"], file=sys.stderr)
+            return 1
+        if args.profile:
+            try:
+                paths = export_targets(im, opts, load_profile(cfg["export_profile"]))
+            except ExportError as e:
+                for path in e.paths:
+                    print(path)
+                print(e, file=sys.stderr)
+                return 1
+            for path in paths:
+                print(path)
+        else:
+            print(save_image_file(im, None, opts))
+        return 0
+    if args.command == "batch":
+        sources = expand_inputs(args.inputs, args.recursive)
+        if not sources:
+            print("no input images found", file=sys.stderr)
+            return 1
+        stats = run_batch(sources, opts, args.jobs)
+        return 1 if stats["failed"] else 0
 
 
 # ----------------------------------------------------------
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        import multiprocessing
+        multiprocessing.freeze_support()
+        sys.exit(cli_main())
+    if tk is None:
+        print("tkinter is required for the GUI; the command line works without it "
+              "(clipimg.py --help)", file=sys.stderr)
+        sys.exit(1)
     if sys.platform == "win32":
         try:
             from ctypes import windll